@@ -0,0 +1,131 @@
+"""Per-request cost of the generation clients: the OpenAI SDK path against the lean httpx path.
+
+Each client runs in its own process against a stand-in server in a separate process, so the numbers
+cover only the client side: CPU per request, wall time per request, peak traced allocation
+during a request (tracemalloc) and peak RSS of the process.
+
+    python benchmarks/bench_client.py --requests 500 --output bench_client.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+
+from bench_common import ADDON_DIR, load_core, peak_rss_mb
+
+CLIENTS = ('sdk', 'lean')
+
+def run_worker(args):
+    core = load_core()
+    settings = {"API Key": "benchmark", "Base URL": args.base_url, "Generation Client": args.client}
+    client = core.create_image_client(settings)
+    prompt = "A simple, friendly illustration of a lantern by a harbor at night. The image has no text."
+
+    # Warm the connection pool and lazy imports before measuring
+    for _ in range(5):
+        client.generate(prompt)
+
+    wall_times = []
+    cpu_start = time.process_time()
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        client.generate(prompt)
+        wall_times.append(time.perf_counter() - start)
+    cpu_seconds = time.process_time() - cpu_start
+
+    # Allocation peaks are measured in a separate pass, tracemalloc slows every allocation down
+    peaks = []
+    tracemalloc.start()
+    for _ in range(min(args.requests, 50)):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        client.generate(prompt)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    client.close()
+
+    # An account out of credit: retrying cannot help, so the error should come back after a single request
+    quota_client = core.create_image_client(dict(settings, **{"Base URL": args.quota_base_url}))
+    quota_requests = []
+    quota_client.http_client.event_hooks["request"].append(quota_requests.append)
+    start = time.perf_counter()
+    try:
+        quota_client.generate(prompt)
+    except core.API_ERRORS:
+        pass
+    quota_error_ms = (time.perf_counter() - start) * 1000
+    quota_client.close()
+
+    print(json.dumps({
+        "client": args.client,
+        "requests": args.requests,
+        "cpu_ms_per_request": cpu_seconds * 1000 / args.requests,
+        "wall_ms_p50": statistics.median(wall_times) * 1000,
+        "wall_ms_max": max(wall_times) * 1000,
+        "traced_peak_kib_per_request": statistics.median(peaks) / 1024,
+        "peak_rss_mb": peak_rss_mb(),
+        "quota_error_requests": len(quota_requests),
+        "quota_error_ms": quota_error_ms
+    }))
+
+def start_stand_in_server(*extra_args):
+    server = subprocess.Popen([sys.executable, '-u', os.path.join(ADDON_DIR, 'devserver.py'), '--port', '0',
+                               '--image-noise-bits', '0', *extra_args], stdout=subprocess.PIPE, text=True)
+    # The server prints its Base URL once it is listening
+    line = server.stdout.readline()
+    return server, line.strip().rsplit(' ', 1)[-1]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--clients', default=','.join(CLIENTS))
+    parser.add_argument('--output', default='bench_client.json')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--client', default=CLIENTS[0], help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    parser.add_argument('--quota-base-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    server, base_url = start_stand_in_server()
+    # Answers every request with insufficient_quota
+    quota_server, quota_base_url = start_stand_in_server('--quota', '0')
+    results = []
+    try:
+        for client in args.clients.split(','):
+            completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', '--client', client,
+                                        '--requests', str(args.requests), '--base-url', base_url,
+                                        '--quota-base-url', quota_base_url],
+                                       capture_output=True, text=True)
+            if completed.returncode != 0:
+                raise RuntimeError(f"Benchmark worker failed:\n{completed.stderr}")
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{client:<6} {result['cpu_ms_per_request']:>7.2f} ms CPU/request  p50 {result['wall_ms_p50']:>6.2f} ms  "
+                  f"{result['traced_peak_kib_per_request']:>7.1f} KiB traced peak  peak RSS {result['peak_rss_mb']:.1f} MB  "
+                  f"quota error after {result['quota_error_requests']} requests, {result['quota_error_ms']:.0f} ms")
+    finally:
+        server.terminate()
+        quota_server.terminate()
+
+    report = {
+        "benchmark": "client",
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=4)
+    print(f"Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""What the benchmark scripts share: where the addon is, importing core.py without Anki, and peak RSS."""
+import os
+import sys
+import types
+import importlib
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADDON_DIR = os.path.join(REPO_DIR, 'src')
+
+def load_core():
+    # Import core.py as part of the addon package without running __init__.py, which needs aqt
+    package = types.ModuleType('dalleforanki')
+    package.__path__ = [ADDON_DIR]
+    sys.modules['dalleforanki'] = package
+    sys.path.append(os.path.join(ADDON_DIR, 'lib'))
+    return importlib.import_module('dalleforanki.core')
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None  # Not available on Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
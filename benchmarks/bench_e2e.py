@@ -0,0 +1,143 @@
+"""End-to-end throughput benchmark for the generation pipeline.
+
+Runs note -> prompt -> generate -> download -> resize -> write -> note update against the local
+stand-in server (src/devserver.py) with synthetic collections, one subprocess per configuration
+so peak RSS and CPU time are measured per run. Results are written to a JSON file.
+
+The pipeline runs through core.py without Anki or Qt; the addon's dependencies (httpx, openai, Pillow)
+must be importable, either installed or from src/lib when running the same Python version.
+
+    python benchmarks/bench_e2e.py --sizes 100,1000 --api-latency fixed:0.05 --output bench_e2e.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from fake_collection import FakeCollection
+from bench_common import ADDON_DIR, load_core, peak_rss_mb
+
+
+# Engines the worker loop supports; each one becomes a benchmark configuration
+ENGINES = ['sdk', 'lean']
+
+def run_worker(args):
+    """Runs a single configuration in this process and prints its result as JSON."""
+    core = load_core()
+    import dalleforanki.devserver as devserver
+
+    work_dir = tempfile.mkdtemp(prefix='dalleforanki-bench-')
+    media_dir = os.path.join(work_dir, 'media')
+    os.makedirs(media_dir)
+
+    with open(os.path.join(ADDON_DIR, 'config.json')) as config:
+        settings = json.load(config)
+    server = devserver.start_server(devserver.StandInConfig(api_latency=args.api_latency, cdn_latency=args.cdn_latency,
+                                                            seed=args.seed))
+    settings.update({
+        "API Key": "benchmark",
+        "Base URL": server.base_url,
+        "Term Field": "Term",
+        "Sentence Field": "Sentence",
+        "Image Field": "Image",
+        "Resize Height": args.resize,
+        "Conflict Action": 0,
+        "Skip Rejected Prompts": False,
+        "Generation Client": args.engine,
+        "Note Order": args.note_order
+    })
+    col = FakeCollection(media_dir)
+    nids = col.populate(args.size, seed=args.seed, empty_sentence_ratio=args.empty_sentence_ratio)
+
+    # Keep the addon's state files and logs out of the real addon folder
+    core.ADDON_DIR = work_dir
+    core.configure_run(settings)
+    image_client = core.create_image_client(settings)
+    engine = core.GenerationRun(core.CollectionAdapter(col), image_client, nids, settings)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    success_count, error_count, _ = engine.run()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    result = {
+        "engine": args.engine,
+        "notes": args.size,
+        "successes": success_count,
+        "errors": error_count,
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "images_per_second": success_count / wall if wall else None,
+        "cpu_ms_per_image": cpu * 1000 / success_count if success_count else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "collection": col.stats(),
+        "missing_media": len(col.missing_media()),
+        "stages": engine.stats.to_dict()["stages"]
+    }
+    image_client.close()
+    server.shutdown()
+    print(json.dumps(result))
+
+def run_configuration(args, engine, size):
+    command = [sys.executable, os.path.abspath(__file__), '--worker', '--engine', engine,
+               '--size', str(size), '--api-latency', args.api_latency,
+               '--cdn-latency', args.cdn_latency, '--resize', str(args.resize), '--seed', str(args.seed),
+               '--empty-sentence-ratio', str(args.empty_sentence_ratio), '--note-order', str(args.note_order)]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark worker failed:\n{completed.stderr}")
+    # The worker prints log lines from the addon before the result, which is always the last line
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000', help='Comma separated collection sizes')
+    parser.add_argument('--engines', default=','.join(ENGINES))
+    parser.add_argument('--api-latency', default='fixed:0', help='Stand-in server latency, see devserver.py')
+    parser.add_argument('--cdn-latency', default='fixed:0')
+    parser.add_argument('--resize', type=int, default=1, help='Resize Height setting: 0=256px, 1=512px, 2=no resize')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--empty-sentence-ratio', type=float, default=0.2, help='Share of notes with an empty Sentence field')
+    parser.add_argument('--note-order', type=int, default=0,
+                        help='Note Order setting: 0=selection, 1=due date, 2=new card position, 3=deck, 4=random')
+    parser.add_argument('--output', default='bench_e2e.json')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--engine', default=ENGINES[0], help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, default=100, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    results = []
+    for engine in args.engines.split(','):
+        for size in (int(size) for size in args.sizes.split(',')):
+            result = run_configuration(args, engine, size)
+            results.append(result)
+            total = result["stages"]["total"]
+            print(f"{engine:<6} {size:>6} notes: {result['images_per_second']:.1f} images/s, "
+                  f"p50 {total['p50'] * 1000:.0f}ms, p99 {total['p99'] * 1000:.0f}ms, "
+                  f"{result['cpu_ms_per_image']:.1f}ms CPU/image, peak RSS {result['peak_rss_mb']} MB")
+
+    report = {
+        "benchmark": "e2e",
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {"api_latency": args.api_latency, "cdn_latency": args.cdn_latency,
+                       "resize": args.resize, "seed": args.seed,
+                       "empty_sentence_ratio": args.empty_sentence_ratio, "note_order": args.note_order},
+        "results": results
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=4)
+    print(f"Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
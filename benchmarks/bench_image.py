@@ -0,0 +1,226 @@
+"""Microbenchmarks for the resize and encode step, core.resize_image and core.write_media_file.
+
+Compares resampling filters, reduce/draft shortcuts and output formats on 1024x1024 inputs,
+reporting median time per image, bytes out and PSNR against a reference. Only needs Pillow.
+
+    python benchmarks/bench_image.py --height 512 --repeat 5 --output bench_image.json
+    python benchmarks/bench_image.py --images ~/dalle-samples   # use real generations instead of synthetic ones
+
+Resize variants are compared against a LANCZOS resize, the addon's current choice. Encode variants
+are compared against the resized image they encode, so lossless formats report infinite PSNR.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import statistics
+from io import BytesIO
+
+from PIL import Image, ImageChops, ImageStat, features
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'src'))
+import devserver
+
+RESAMPLING_FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+def synthetic_images(count, seed):
+    """Stand-in server PNGs plus a smoother fractal image, roughly bracketing how well real generations compress."""
+    rng = random.Random(seed)
+    images = {}
+    for variant in range(count):
+        images[f"gradient-noise-{variant}"] = devserver.make_png(1024, 1024, variant, 5, rng)
+    fractal = Image.merge("RGB", [Image.effect_mandelbrot((1024, 1024), extent, 256)
+                                  for extent in ((-2.0, -1.5, 1.0, 1.5), (-1.8, -1.2, 0.6, 1.2), (-1.5, -1.0, 0.5, 1.0))])
+    buffer = BytesIO()
+    fractal.save(buffer, format="PNG")
+    images["fractal"] = buffer.getvalue()
+    return images
+
+def load_images(directory):
+    images = {}
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
+            with open(os.path.join(directory, name), 'rb') as image_file:
+                images[name] = image_file.read()
+    return images
+
+def psnr(reference, image):
+    if image.mode != reference.mode:
+        image = image.convert(reference.mode)
+    # Per-channel sum of squared differences, averaged over every channel sample
+    squared = ImageStat.Stat(ImageChops.difference(reference, image)).sum2
+    mse = sum(squared) / (len(squared) * reference.width * reference.height)
+    return math.inf if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+def time_call(function, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+def target_size(image, height):
+    return int(height * image.width / image.height), height
+
+def resize_variants(data, height):
+    """Each variant takes the downloaded bytes and returns the resized image, decode included."""
+    variants = {}
+    for name, resample in RESAMPLING_FILTERS.items():
+        variants[f"resize-{name}"] = lambda resample=resample: (
+            lambda image: image.resize(target_size(image, height), resample))(Image.open(BytesIO(data)))
+    # reducing_gap shrinks by an integer factor with a box filter first, then resamples the rest
+    for gap in (2.0, 3.0):
+        variants[f"resize-lanczos-gap{gap:g}"] = lambda gap=gap: (
+            lambda image: image.resize(target_size(image, height), Image.Resampling.LANCZOS, reducing_gap=gap))(
+            Image.open(BytesIO(data)))
+    variants["reduce-then-lanczos"] = lambda: reduce_then_resize(Image.open(BytesIO(data)), height)
+    variants["thumbnail"] = lambda: thumbnail(Image.open(BytesIO(data)), height)
+    return variants
+
+def reduce_then_resize(image, height):
+    factor = image.height // height
+    if factor > 1:
+        image = image.reduce(factor)
+    return image.resize(target_size(image, height), Image.Resampling.LANCZOS)
+
+def thumbnail(image, height):
+    image.thumbnail((image.width * height // image.height, height), Image.Resampling.LANCZOS)
+    return image
+
+def draft_variants(data, height):
+    """Draft mode only exists for JPEG, where the decoder can skip straight to a scaled-down DCT."""
+    source = Image.open(BytesIO(data)).convert("RGB")
+    buffer = BytesIO()
+    source.save(buffer, format="JPEG", quality=95)
+    jpeg_data = buffer.getvalue()
+
+    def draft_resize():
+        image = Image.open(BytesIO(jpeg_data))
+        image.draft("RGB", target_size(image, height))
+        return image.resize(target_size(image, height), Image.Resampling.LANCZOS)
+
+    return {
+        "jpeg-input-lanczos": lambda: (lambda image: image.resize(target_size(image, height), Image.Resampling.LANCZOS))(
+            Image.open(BytesIO(jpeg_data))),
+        "jpeg-input-draft-lanczos": draft_resize,
+    }
+
+def encode_variants():
+    """Each variant takes a resized image and returns the encoded bytes and the file format."""
+    variants = {}
+    for level in range(10):
+        variants[f"png-level{level}"] = lambda image, level=level: (encode(image, "PNG", compress_level=level), "PNG")
+    variants["png-optimize"] = lambda image: (encode(image, "PNG", optimize=True), "PNG")
+    variants["png-quantize-mediancut"] = lambda image: (
+        encode(image.quantize(256, method=Image.Quantize.MEDIANCUT), "PNG"), "PNG")
+    variants["png-quantize-fastoctree"] = lambda image: (
+        encode(image.quantize(256, method=Image.Quantize.FASTOCTREE), "PNG"), "PNG")
+    for quality in (75, 85, 95):
+        variants[f"jpeg-q{quality}"] = lambda image, quality=quality: (
+            encode(image.convert("RGB"), "JPEG", quality=quality), "JPEG")
+    if features.check("webp"):
+        for quality in (75, 90):
+            variants[f"webp-q{quality}"] = lambda image, quality=quality: (encode(image, "WEBP", quality=quality), "WEBP")
+        variants["webp-lossless"] = lambda image: (encode(image, "WEBP", lossless=True), "WEBP")
+    return variants
+
+def encode(image, image_format, **options):
+    buffer = BytesIO()
+    image.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+def summarize(rows):
+    """Averages each variant over all inputs."""
+    grouped = {}
+    for row in rows:
+        grouped.setdefault((row["group"], row["variant"]), []).append(row)
+    summary = []
+    for (group, variant), variant_rows in grouped.items():
+        psnr_values = [row["psnr"] for row in variant_rows]
+        summary.append({
+            "group": group,
+            "variant": variant,
+            "ms_per_image": statistics.mean(row["seconds"] for row in variant_rows) * 1000,
+            "bytes_out": statistics.mean(row["bytes_out"] for row in variant_rows) if "bytes_out" in variant_rows[0] else None,
+            "psnr": math.inf if math.inf in psnr_values else statistics.mean(psnr_values)
+        })
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', help='Directory of sample images (default: synthetic 1024x1024 images)')
+    parser.add_argument('--synthetic-count', type=int, default=2)
+    parser.add_argument('--height', type=int, default=512, help='Target height, 512 is the addon default')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per variant, the median is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_image.json')
+    args = parser.parse_args()
+
+    images = load_images(args.images) if args.images else synthetic_images(args.synthetic_count, args.seed)
+    rows = []
+    for image_name, data in images.items():
+        reference = Image.open(BytesIO(data))
+        reference = reference.resize(target_size(reference, args.height), Image.Resampling.LANCZOS)
+
+        decode_seconds, _ = time_call(lambda: Image.open(BytesIO(data)).load(), args.repeat)
+        rows.append({"image": image_name, "group": "decode", "variant": "decode", "seconds": decode_seconds,
+                     "bytes_in": len(data), "psnr": math.inf})
+
+        for group, variants in (("resize", resize_variants(data, args.height)), ("draft", draft_variants(data, args.height))):
+            for variant, function in variants.items():
+                seconds, resized = time_call(function, args.repeat)
+                rows.append({"image": image_name, "group": group, "variant": variant, "seconds": seconds,
+                             "psnr": psnr(reference, resized)})
+
+        for variant, function in encode_variants().items():
+            seconds, (encoded, _) = time_call(lambda: function(reference), args.repeat)
+            decoded = Image.open(BytesIO(encoded))
+            rows.append({"image": image_name, "group": "encode", "variant": variant, "seconds": seconds,
+                         "bytes_out": len(encoded), "psnr": psnr(reference, decoded)})
+
+    summary = summarize(rows)
+    print(f"{'Variant':<28}{'ms/image':>10}{'KiB out':>10}{'PSNR dB':>10}")
+    for row in summary:
+        kib = f"{row['bytes_out'] / 1024:>10.0f}" if row["bytes_out"] is not None else f"{'':>10}"
+        print(f"{row['variant']:<28}{row['ms_per_image']:>10.1f}{kib}{row['psnr']:>10.1f}")
+
+    report = {
+        "benchmark": "image",
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "pillow": Image.__version__,
+        "platform": platform.platform(),
+        "parameters": {"height": args.height, "repeat": args.repeat, "images": args.images or "synthetic"},
+        "summary": summary,
+        "results": rows
+    }
+    with open(args.output, 'w') as output:
+        # JSON has no infinity, lossless results are written as null
+        json.dump(replace_infinity(report), output, indent=4)
+    print(f"Results written to {args.output}")
+
+def replace_infinity(value):
+    if isinstance(value, float) and math.isinf(value):
+        return None
+    if isinstance(value, dict):
+        return {key: replace_infinity(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [replace_infinity(item) for item in value]
+    return value
+
+if __name__ == '__main__':
+    main()
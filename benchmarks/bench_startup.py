@@ -0,0 +1,240 @@
+"""Import-time and startup-impact benchmark for the addon.
+
+Measures, each in a fresh process so nothing is cached between runs:
+  startup  importing the addon package the way Anki does at launch
+  cold     opening the dialog the first time: importing gui.py and the generation stack, building the dialog
+  warm     the same after the background warm-up (started when the browser opens) has finished
+  profile  Anki's profile_did_open hook with every background feature off, which should import nothing heavy
+
+and reports wall time, modules imported and RSS growth for each, plus a `-X importtime` breakdown
+of the cold path per vendored package, so a dependency that starts to dominate shows up as a regression.
+
+    python benchmarks/bench_startup.py --repeat 5 --output bench_startup.json
+
+To see what the first use after installing costs, point --addon-dir at an extracted .ankiaddon (see
+build_addon.py) and pass --no-write-bytecode, so every run starts with only the bytecode it shipped with:
+
+    python benchmarks/bench_startup.py --addon-dir /tmp/addon --no-write-bytecode
+
+Anki has already imported aqt and Qt before it loads addons, so those are imported before timing
+starts. Without the `aqt` package installed, a minimal stand-in for aqt is used: the numbers then
+cover the addon's own imports only and the dialog is not constructed.
+"""
+import os
+import re
+import sys
+import json
+import time
+import types
+import argparse
+import platform
+import statistics
+import subprocess
+import importlib.util
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_ADDON_DIR = os.path.join(REPO_DIR, 'src')
+PACKAGE_NAME = 'dalleforanki'
+SCENARIOS = ('startup', 'cold', 'warm', 'profile')
+BACKGROUND_SETTINGS = ("Generate While Reviewing", "Generate For New Notes", "Auto Retry Failed")
+VENDORED_PACKAGES = ('openai', 'pydantic', 'pydantic_core', 'httpx', 'httpcore', 'anyio', 'PIL')
+TIMED_MARKER = '-- timed section --'
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except OSError:
+        # Not Linux, fall back to the peak, which is what grows during imports anyway
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def install_aqt_stand_in():
+    class StandIn:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def __getattr__(self, name):
+            return StandIn()
+
+    def module_getattr(name):
+        return type(name, (StandIn,), {})
+
+    aqt = types.ModuleType('aqt')
+    aqt.mw = None
+    qt = types.ModuleType('aqt.qt')
+    qt.__getattr__ = module_getattr
+    qt.pyqtSignal = lambda *args: None
+    gui_hooks = types.ModuleType('aqt.gui_hooks')
+    gui_hooks.browser_will_show = []
+    gui_hooks.reviewer_did_show_question = []
+    gui_hooks.reviewer_will_end = []
+    gui_hooks.add_cards_did_add_note = []
+    gui_hooks.profile_did_open = []
+    gui_hooks.profile_will_close = []
+    gui_hooks.state_did_change = []
+    gui_hooks.focus_did_change = []
+    gui_hooks.sync_will_start = []
+    gui_hooks.sync_did_finish = []
+    gui_hooks.media_sync_did_start_or_stop = []
+    utils = types.ModuleType('aqt.utils')
+    utils.tooltip = utils.showText = print
+    aqt.qt, aqt.gui_hooks, aqt.utils = qt, gui_hooks, utils
+    sys.modules.update({'aqt': aqt, 'aqt.qt': qt, 'aqt.gui_hooks': gui_hooks, 'aqt.utils': utils})
+
+def prepare_host():
+    """Imports what Anki has loaded before addons; returns whether this is the real aqt."""
+    try:
+        import aqt.qt
+        import aqt.utils
+        import aqt.gui_hooks
+    except ImportError:
+        install_aqt_stand_in()
+        return False
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    aqt.qt.QApplication.instance() or aqt.qt.QApplication([])
+    return True
+
+def import_addon(addon_dir):
+    spec = importlib.util.spec_from_file_location(PACKAGE_NAME, os.path.join(addon_dir, '__init__.py'),
+                                                  submodule_search_locations=[addon_dir])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE_NAME] = package
+    spec.loader.exec_module(package)
+    return package
+
+def open_dialog(real_aqt):
+    gui = importlib.import_module(f'{PACKAGE_NAME}.gui')
+    if real_aqt:
+        # The browser is only used once notes are selected, which this does not time
+        gui.AIApp(None)
+
+def open_profile(addon_dir):
+    with open(os.path.join(addon_dir, 'config.json')) as config:
+        settings = json.load(config)
+    enabled = [name for name in BACKGROUND_SETTINGS if settings.get(name)]
+    if enabled:
+        raise RuntimeError(f"The profile scenario needs these off in config.json: {', '.join(enabled)}")
+    from aqt import gui_hooks
+    hook = gui_hooks.profile_did_open
+    if callable(hook):
+        hook()
+    else:
+        for callback in hook:
+            callback()
+
+def run_worker(scenario, addon_dir):
+    real_aqt = prepare_host()
+    if scenario != 'startup':
+        package = import_addon(addon_dir)
+        if scenario == 'warm':
+            package.warm_up()
+
+    # -X importtime output before this line belongs to the host, not to the measured step
+    print(TIMED_MARKER, file=sys.stderr, flush=True)
+    modules_before = len(sys.modules)
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+    if scenario == 'startup':
+        import_addon(addon_dir)
+    elif scenario == 'profile':
+        open_profile(addon_dir)
+    else:
+        open_dialog(real_aqt)
+    seconds = time.perf_counter() - start
+    print(json.dumps({
+        "scenario": scenario,
+        "real_aqt": real_aqt,
+        "seconds": seconds,
+        "modules": len(sys.modules) - modules_before,
+        "rss_delta_mb": current_rss_mb() - rss_before
+    }))
+
+def run_scenario(scenario, args, extra_args=()):
+    python_args = ['-B', *extra_args] if args.no_write_bytecode else extra_args
+    completed = subprocess.run([sys.executable, *python_args, os.path.abspath(__file__), '--worker', scenario,
+                                '--addon-dir', args.addon_dir], capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark worker failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+def importtime_breakdown(stderr):
+    """Self time per top-level package from `-X importtime` output, in milliseconds."""
+    by_package = {}
+    top_level = {}
+    for line in stderr.split(TIMED_MARKER, 1)[-1].splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, module = int(match[1]), int(match[2]), match[3], match[4]
+        package = module.split('.')[0]
+        if package == PACKAGE_NAME and '.' in module:
+            package = module  # Keep the addon's own modules apart
+        by_package[package] = by_package.get(package, 0) + self_us / 1000
+        # Modules imported directly by the addon are the least indented ones under it
+        if len(indent) <= 3:
+            top_level[module] = cumulative_us / 1000
+    vendored = {package: round(by_package.pop(package, 0.0), 1) for package in VENDORED_PACKAGES}
+    return {
+        "vendored_self_ms": vendored,
+        "vendored_total_ms": round(sum(vendored.values()), 1),
+        "other_self_ms": {package: round(ms, 1) for package, ms in
+                          sorted(by_package.items(), key=lambda item: -item[1])[:15]},
+        "largest_cumulative_ms": {module: round(ms, 1) for module, ms in
+                                  sorted(top_level.items(), key=lambda item: -item[1])[:10]}
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='Fresh processes per scenario, medians are reported')
+    parser.add_argument('--output', default='bench_startup.json')
+    parser.add_argument('--addon-dir', default=DEFAULT_ADDON_DIR, help='Addon folder to load, src by default')
+    parser.add_argument('--no-write-bytecode', action='store_true',
+                        help="Don't let runs write .pyc files, so each one is a first use")
+    parser.add_argument('--worker', choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, os.path.abspath(args.addon_dir))
+        return
+
+    results = {}
+    for scenario in SCENARIOS:
+        runs = [run_scenario(scenario, args)[0] for _ in range(args.repeat)]
+        results[scenario] = {
+            "real_aqt": runs[0]["real_aqt"],
+            "seconds_median": statistics.median(run["seconds"] for run in runs),
+            "seconds_min": min(run["seconds"] for run in runs),
+            "modules": runs[0]["modules"],
+            "rss_delta_mb_median": statistics.median(run["rss_delta_mb"] for run in runs),
+            "runs": runs
+        }
+        print(f"{scenario:<8} {results[scenario]['seconds_median'] * 1000:>8.1f} ms  {results[scenario]['modules']:>5} modules  "
+              f"{results[scenario]['rss_delta_mb_median']:>6.1f} MB RSS")
+
+    _, stderr = run_scenario('cold', args, ['-X', 'importtime'])
+    breakdown = importtime_breakdown(stderr)
+    print("\nSelf import time of vendored packages on first dialog open:")
+    for package, ms in sorted(breakdown["vendored_self_ms"].items(), key=lambda item: -item[1]):
+        print(f"  {package:<15}{ms:>8.1f} ms")
+    if not results['startup']['real_aqt']:
+        print("\naqt is not installed, a stand-in was used and the dialog was not constructed")
+
+    report = {
+        "benchmark": "startup",
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "addon_dir": os.path.abspath(args.addon_dir),
+        "write_bytecode": not args.no_write_bytecode,
+        "results": results,
+        "importtime": breakdown
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=4)
+    print(f"Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""A stand-in for Anki's collection (mw.col) for runs at scale without an Anki profile.
+
+Notes live in SQLite with their fields joined by 0x1f like Anki stores them, so 100k notes cost a few
+tens of MB and every get_note/update_note pays for a real row read or write. Every write and every
+transaction is counted, so a run can be checked for both speed (writes per note, transactions per
+note) and correctness (each note got one image tag, each referenced file exists).
+
+    col = FakeCollection(media_dir)
+    col.populate(100000, seed=1, empty_sentence_ratio=0.3, existing_image_ratio=0.1)
+    col.db.all('select nid, queue, due from cards')  # Scheduling data, like Anki's cards table
+    ...
+    assert col.transaction_count == col.write_count and not col.missing_media()
+"""
+import os
+import re
+import random
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+FIELD_SEPARATOR = '\x1f'
+DEFAULT_FIELDS = ('Term', 'Sentence', 'Image')
+IMAGE_TAG = re.compile(r"<img src='([^']+)' />")
+
+# Share of cards in each queue: new, learning, review, suspended (Anki's queue numbers 0, 1, 2, -1)
+DEFAULT_QUEUE_WEIGHTS = {0: 0.5, 1: 0.05, 2: 0.35, -1: 0.1}
+TODAY = 1000  # Collection day number, review due dates are in days like in Anki
+
+WORDS = ('apple river mountain teacher window garden lantern whisper harbor meadow violin thunder blanket '
+         'compass orchard pebble candle feather kettle ladder bicycle festival glacier harvest island jungle '
+         'library market needle ocean parrot quarry saddle theatre umbrella valley wagon yacht zebra').split()
+
+class FakeNote:
+    def __init__(self, col, nid, fields, tags):
+        self.col = col
+        self.id = nid
+        self.fields = fields
+        self.tags = tags
+
+    def __getitem__(self, field_name):
+        return self.fields[self.col.field_index[field_name]]
+
+    def __setitem__(self, field_name, value):
+        self.fields[self.col.field_index[field_name]] = value
+
+    def keys(self):
+        return list(self.col.field_names)
+
+    def note_type(self):
+        return self.col.model
+
+    def add_tag(self, tag):
+        if tag not in self.tags:
+            self.tags.append(tag)
+
+class FakeMedia:
+    def __init__(self, media_dir):
+        self.media_dir = media_dir
+
+    def dir(self):
+        return self.media_dir
+
+class FakeModels:
+    def field_names(self, model):
+        return [field["name"] for field in model["flds"]]
+
+class FakeDecks:
+    def __init__(self):
+        self.names = {}
+
+    def name(self, did):
+        return self.names.get(did, 'Default')
+
+class FakeSched:
+    today = TODAY
+
+class FakeDB(sqlite3.Connection):
+    def all(self, sql, *args):
+        return [list(row) for row in self.execute(sql, args)]
+
+class FakeCollection:
+    def __init__(self, media_dir, field_names=DEFAULT_FIELDS, path=':memory:'):
+        self.field_names = tuple(field_names)
+        self.field_index = {name: index for index, name in enumerate(self.field_names)}
+        self.model = {"name": "Basic (image)", "flds": [{"name": name} for name in self.field_names]}
+        self.media = FakeMedia(media_dir)
+        self.models = FakeModels()
+        self.decks = FakeDecks()
+        self.sched = FakeSched()
+        # The engine runs on a worker thread, so the connection is shared and guarded by a lock
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, factory=FakeDB)
+        self.db.execute('CREATE TABLE IF NOT EXISTS notes (id INTEGER PRIMARY KEY, flds TEXT NOT NULL, tags TEXT NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cards (id INTEGER PRIMARY KEY, nid INTEGER NOT NULL, did INTEGER NOT NULL, '
+                        'odid INTEGER NOT NULL, queue INTEGER NOT NULL, due INTEGER NOT NULL, odue INTEGER NOT NULL)')
+        self.lock = threading.RLock()
+        self.read_count = 0
+        self.write_count = 0
+        self.transactions = []  # (operation, notes written) for every committed transaction
+        self._transaction = None
+
+    def populate(self, count, seed=0, empty_sentence_ratio=0.2, existing_image_ratio=0.0,
+                 term_words=(1, 2), sentence_words=(4, 16), first_nid=1, cards_per_note=(1, 1),
+                 queue_weights=DEFAULT_QUEUE_WEIGHTS, review_days=(-30, 365), decks=('Default',)):
+        """Adds synthetic notes and their cards; contents and scheduling are drawn from the given distributions."""
+        rng = random.Random(seed)
+        rows = []
+        card_rows = []
+        self.decks.names.update({index + 1: name for index, name in enumerate(decks)})
+        queues, weights = zip(*queue_weights.items())
+        for nid in range(first_nid, first_nid + count):
+            values = {
+                'Term': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(*term_words))),
+                'Sentence': '' if rng.random() < empty_sentence_ratio else ' '.join(
+                    rng.choice(WORDS) for _ in range(rng.randint(*sentence_words))),
+                'Image': "<img src='existing.png' />" if rng.random() < existing_image_ratio else ''
+            }
+            rows.append((nid, FIELD_SEPARATOR.join(values.get(name, '') for name in self.field_names), ''))
+            for _ in range(rng.randint(*cards_per_note)):
+                queue = rng.choices(queues, weights)[0]
+                if queue == 0:
+                    due = nid  # New card position
+                elif queue == 1:
+                    due = 1700000000 + rng.randint(0, 86400)  # Learning cards are due at a timestamp
+                else:
+                    due = TODAY + rng.randint(*review_days)
+                card_rows.append((nid, rng.randint(1, len(decks)), 0, queue, due, 0))
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT INTO notes VALUES (?, ?, ?)', rows)
+            self.db.executemany('INSERT INTO cards (nid, did, odid, queue, due, odue) VALUES (?, ?, ?, ?, ?, ?)', card_rows)
+            self.db.execute('COMMIT')
+        return list(range(first_nid, first_nid + count))
+
+    def note_count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM notes').fetchone()[0]
+
+    def find_notes(self, query=''):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT id FROM notes ORDER BY id')]
+
+    def get_note(self, nid):
+        with self.lock:
+            row = self.db.execute('SELECT flds, tags FROM notes WHERE id = ?', (nid,)).fetchone()
+            self.read_count += 1
+        if row is None:
+            raise KeyError(f"Note {nid} not found")
+        return FakeNote(self, nid, row[0].split(FIELD_SEPARATOR), row[1].split())
+
+    @contextmanager
+    def transaction(self, operation):
+        """Groups writes into one commit, the way a single collection operation does in Anki."""
+        with self.lock:
+            if self._transaction is not None:
+                raise RuntimeError(f"Nested transaction {operation} inside {self._transaction[0]}")
+            self.db.execute('BEGIN')
+            self._transaction = [operation, 0]
+            try:
+                yield
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                self._transaction = None
+                raise
+            self.db.execute('COMMIT')
+            self.transactions.append(tuple(self._transaction))
+            self._transaction = None
+
+    def _write(self, note):
+        self.db.execute('UPDATE notes SET flds = ?, tags = ? WHERE id = ?',
+                        (FIELD_SEPARATOR.join(note.fields), ' '.join(note.tags), note.id))
+        self.write_count += 1
+        self._transaction[1] += 1
+
+    def update_note(self, note):
+        with self.transaction('update_note'):
+            self._write(note)
+
+    def update_notes(self, notes):
+        with self.transaction('update_notes'):
+            for note in notes:
+                self._write(note)
+
+    @property
+    def transaction_count(self):
+        return len(self.transactions)
+
+    def image_filenames(self, nid):
+        return IMAGE_TAG.findall(self.get_note(nid)['Image'])
+
+    def missing_media(self):
+        """Image files referenced by a note but absent from the media folder."""
+        media_files = set(os.listdir(self.media.dir()))
+        with self.lock:
+            rows = self.db.execute('SELECT flds FROM notes').fetchall()
+        image_index = self.field_index['Image']
+        return [filename for (fields,) in rows for filename in IMAGE_TAG.findall(fields.split(FIELD_SEPARATOR)[image_index])
+                if filename != 'existing.png' and filename not in media_files]
+
+    def stats(self):
+        return {
+            "notes": self.note_count(),
+            "reads": self.read_count,
+            "writes": self.write_count,
+            "transactions": self.transaction_count,
+            "notes_per_transaction": self.write_count / self.transaction_count if self.transaction_count else None
+        }
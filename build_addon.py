@@ -0,0 +1,89 @@
+"""Packages the contents of src into an .ankiaddon file with precompiled bytecode.
+
+Without bytecode in the package, the first use of the addon compiles several hundred vendored modules,
+and again on every start when the addon folder is not writable. The package ships a __pycache__ for:
+  lib/      unchecked-hash .pyc files: used without looking at the source, so they stay valid even
+            though Anki does not keep file modification times when it extracts the addon
+  the addon's own modules
+            checked-hash .pyc files, so edits to core.py and the others (see Advanced Usage) still apply
+
+Python only loads bytecode compiled for its own version, so run this with the Python version Anki
+ships (the vendored extension modules in lib are built for it):
+
+    py -3.9 build_addon.py --output dalleforanki.ankiaddon
+"""
+import os
+import re
+import sys
+import shutil
+import zipfile
+import argparse
+import compileall
+import tempfile
+import py_compile
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.join(REPO_DIR, 'src')
+LIB_DIR_NAME = 'lib'
+EXTENSION_TAG = re.compile(r'\.(?:cp|cpython-)(\d+)-')
+
+# Written by Anki or by the addon at runtime, never part of a release
+EXCLUDED_NAMES = {'__pycache__', 'meta.json', 'resume_state.json', 'failed_queue.json', 'rejected_prompts.json',
+                  'fallback_notes.json', 'download_origins.json', 'new_note_queue.json', 'run_stats.json', 'profiles',
+                  'metrics.prom', 'metrics.json'}
+EXCLUDED_PREFIXES = ('run_log.jsonl',)
+
+def vendored_python_tags(lib_dir):
+    tags = set()
+    for _, _, files in os.walk(lib_dir):
+        tags.update(f'cp{match[1]}' for match in map(EXTENSION_TAG.search, files) if match)
+    return tags
+
+def ignore_runtime_files(directory, names):
+    return [name for name in names if name in EXCLUDED_NAMES or name.startswith(EXCLUDED_PREFIXES)]
+
+def compile_tree(staging_dir):
+    lib_dir = os.path.join(staging_dir, LIB_DIR_NAME)
+    addon_ok = compileall.compile_dir(staging_dir, quiet=1, workers=0, rx=re.compile(re.escape(lib_dir)),
+                                      invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH)
+    lib_ok = compileall.compile_dir(lib_dir, quiet=1, workers=0,
+                                    invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+    return addon_ok and lib_ok
+
+def write_package(staging_dir, output):
+    count = 0
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as package:
+        for root, dirs, files in os.walk(staging_dir):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                package.write(path, os.path.relpath(path, staging_dir))
+                count += 1
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', default='dalleforanki.ankiaddon')
+    parser.add_argument('--no-bytecode', action='store_true', help='Package the sources only')
+    parser.add_argument('--any-python', action='store_true',
+                        help="Compile even if this Python does not match the vendored extension modules")
+    args = parser.parse_args()
+
+    current_tag = f'cp{sys.version_info[0]}{sys.version_info[1]}'
+    vendored_tags = vendored_python_tags(os.path.join(ADDON_DIR, LIB_DIR_NAME))
+    if not args.no_bytecode and vendored_tags and current_tag not in vendored_tags and not args.any_python:
+        sys.exit(f"lib is built for {', '.join(sorted(vendored_tags))} but this is {current_tag}: bytecode compiled "
+                 f"here would be ignored by Anki. Run with the matching Python, or pass --any-python.")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        staging_dir = os.path.join(temp_dir, 'src')
+        shutil.copytree(ADDON_DIR, staging_dir, ignore=ignore_runtime_files)
+        if not args.no_bytecode and not compile_tree(staging_dir):
+            sys.exit("Some modules failed to compile, see above")
+        count = write_package(staging_dir, args.output)
+
+    bytecode = 'without bytecode' if args.no_bytecode else f'with bytecode for {sys.implementation.cache_tag}'
+    print(f"Wrote {count} files to {args.output} ({os.path.getsize(args.output) / (1024 * 1024):.1f} MB, {bytecode})")
+
+if __name__ == '__main__':
+    main()
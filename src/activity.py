@@ -0,0 +1,107 @@
+import time
+import threading
+
+# What the user is doing in Anki, fed by the hooks registered in __init__.py, so the background workers
+# (review.py, new_notes.py, retries.py) and dialog runs can stay out of the way:
+#   Paused      AnkiWeb sync is running: no media files are written and no notes saved until it is done
+#   Throttled   the user is reviewing or otherwise using Anki: notes added in the background are spaced out
+#   Full speed  Anki has been idle (or in the background) for "Idle After Seconds"
+
+MODE_FULL = 'Full speed'
+MODE_THROTTLED = 'Throttled'
+MODE_PAUSED = 'Paused'
+
+class ActivityMonitor:
+    # Upper bound on how long a waiting worker goes without checking whether it was stopped
+    WAIT_INTERVAL = 1.0
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.syncing = False
+        self.media_syncing = False
+        self.has_focus = True
+        self.last_activity = time.monotonic()
+        self.reported_mode = None
+        self.on_mode_change = None  # Called with the mode (or None when there is no background work) when it changes
+
+    # Called on the main thread by the hooks
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def set_focus(self, has_focus):
+        self.has_focus = has_focus
+        self.touch()
+
+    def set_syncing(self, syncing):
+        with self.condition:
+            self.syncing = syncing
+            self.condition.notify_all()
+
+    def set_media_syncing(self, media_syncing):
+        with self.condition:
+            self.media_syncing = media_syncing
+            self.condition.notify_all()
+
+    # Called by the workers
+
+    def mode(self, settings):
+        if settings.get("Pause During Sync", True) and (self.syncing or self.media_syncing):
+            return MODE_PAUSED
+        if not self.has_focus or time.monotonic() - self.last_activity >= settings.get("Idle After Seconds", 60):
+            return MODE_FULL
+        return MODE_THROTTLED
+
+    def report(self, mode):
+        if mode != self.reported_mode:
+            self.reported_mode = mode
+            if self.on_mode_change is not None:
+                self.on_mode_change(mode)
+
+    def wait_for_writes(self, settings, stopped=None):
+        """Blocks while a sync is running. Returns False only if stopped while waiting for the sync; otherwise
+        the image that was already paid for is saved, even by a run that is stopping."""
+        if not settings.get("Pause During Sync", True):
+            return True
+        with self.condition:
+            while self.syncing or self.media_syncing:
+                if stopped is not None and stopped():
+                    return False
+                self.condition.wait(self.WAIT_INTERVAL)
+        return True
+
+    def pace(self, settings, stopped):
+        """Called by background workers before each note. Waits out a sync, and for "Throttled Delay Seconds"
+        while the user is active (cut short once Anki goes idle). Returns False if stopped meanwhile."""
+        started = time.monotonic()
+        while not stopped():
+            mode = self.mode(settings)
+            self.report(mode)
+            if mode == MODE_FULL or (mode == MODE_THROTTLED and
+                                     time.monotonic() - started >= settings.get("Throttled Delay Seconds", 20)):
+                return True
+            with self.condition:
+                self.condition.wait(self.WAIT_INTERVAL)
+        return False
+
+monitor = ActivityMonitor()
+
+INDICATOR_TEXT = 'DALL-E Images in Background: {}'
+indicator_action = None
+
+def show_mode(mw, mode):
+    # A disabled entry in the Tools menu, only there while background work is waiting
+    global indicator_action
+    if indicator_action is None:
+        if mode is None:
+            return
+        indicator_action = mw.form.menuTools.addAction('')
+        indicator_action.setEnabled(False)
+    indicator_action.setVisible(mode is not None)
+    if mode is not None:
+        indicator_action.setText(INDICATOR_TEXT.format(mode))
+
+def show_message(message):
+    # Used by the background workers, on the main thread
+    from aqt.utils import tooltip
+    tooltip(message, period=8000)
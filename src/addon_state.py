@@ -0,0 +1,64 @@
+import os
+import json
+import threading
+
+from .metrics import write_atomic
+
+# State files and the saved settings, without the generation stack: the hooks Anki calls on the main thread
+# (cards shown, notes added, profile opened) read these, and importing core.py there would load openai, httpx and PIL.
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def state_path(filename):
+    # State files live next to the addon, whatever Anki's working directory is
+    return os.path.join(ADDON_DIR, filename)
+
+def read_state(filename, default):
+    try:
+        with open(filename, 'r') as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return default
+    except (PermissionError, ValueError) as e:
+        print(f'Could not read {filename}: {e}')
+        return default
+
+def write_state(filename, data):
+    # Replaced in one step, a crash while writing never leaves a half-written file that reads as empty
+    write_atomic(filename, json.dumps(data, indent=4))
+
+class SharedState:
+    """A state file that several runs update at once: the dialog, the review worker and the new-note worker.
+    shared() gives all of them the same instance, so whichever saves last still writes what the others recorded."""
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+
+    @classmethod
+    def shared(cls, filename=None):
+        filename = filename or state_path(cls.FILENAME)
+        with SharedState._instances_lock:
+            if (cls, filename) not in SharedState._instances:
+                SharedState._instances[(cls, filename)] = cls(filename)
+            return SharedState._instances[(cls, filename)]
+
+CONFIG_FILE = 'config.json'
+_saved_settings = {"mtime": None, "settings": {}}
+
+def load_settings():
+    """The settings last saved by the dialog. Read for every card shown, so only parsed again once the file changed.
+    If it cannot be read or parsed, the last good settings are kept and it is tried again on the next call."""
+    path = state_path(CONFIG_FILE)
+    try:
+        mtime = os.stat(path).st_mtime
+        if mtime != _saved_settings["mtime"]:
+            with open(path, 'r') as config:
+                _saved_settings["settings"] = json.load(config)
+            _saved_settings["mtime"] = mtime
+    except (OSError, ValueError) as e:
+        print(f'Could not read the addon config: {e}')
+    return _saved_settings["settings"]
@@ -0,0 +1,1111 @@
+import os
+import json
+import time
+import base64
+import logging
+import random
+import hashlib
+import threading
+from io import BytesIO
+from queue import Queue, Empty
+from datetime import datetime, timezone
+from re import sub
+from urllib.parse import urlsplit, parse_qs
+
+import httpx
+from openai import OpenAI, OpenAIError, APIConnectionError
+from PIL import Image
+
+from . import run_log
+from .metrics import StageTimer, RunStats, RunProgress, METRICS, start_exporter, write_metrics_now
+from .addon_state import state_path, read_state, write_state, SharedState, load_settings
+from .profiling import RunProfiler
+from .net_trace import ConnectionTracer
+
+# The generation pipeline without any aqt import, so it can run headless (benchmarks, scripts) as well as in Anki
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Records go to run_log.jsonl through a background writer, see run_log.py
+def log_error(error_message, **fields):
+    run_log.log_event(error_message, level=logging.ERROR, **fields)
+
+def debug_log(log_data, **fields):
+    run_log.log_event(str(log_data), level=logging.DEBUG, **fields)
+
+# Connections opened by the warm-up have to survive while the user sets up the run (httpx drops them after 5s)
+KEEPALIVE_EXPIRY = 120.0
+
+def create_http_client(tracer=None):
+    # One client per run so the API and the image downloads share a connection pool
+    event_hooks = {"request": [tracer.attach]} if tracer is not None else {}
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=KEEPALIVE_EXPIRY)
+    return httpx.Client(timeout=httpx.Timeout(60.0, connect=10.0), limits=limits, follow_redirects=True,
+                        event_hooks=event_hooks)
+
+def log_request_trace(request_trace, phases, failed):
+    run_log.log_event(f"{request_trace.method} {request_trace.host}{request_trace.path}", stage="http",
+                      duration=round(phases["total"], 4),
+                      data={"status": request_trace.status_code, "failed": failed,
+                            "reused_connection": request_trace.reused_connection,
+                            "phases": {phase: round(seconds, 4) for phase, seconds in phases.items()}})
+
+def configure_logging(settings):
+    run_log.configure(ADDON_DIR,
+                      debug=settings.get("Debug Logging", False),
+                      max_bytes=settings.get("Log Max Bytes", 5 * 1024 * 1024),
+                      backup_count=settings.get("Log Backup Count", 3))
+
+def configure_run(settings):
+    configure_logging(settings)
+    if settings.get("Export Metrics"):
+        start_exporter(settings.get("Metrics Export Dir") or ADDON_DIR, settings.get("Metrics Export Interval Seconds", 15))
+
+def extract_numeric_value(text):
+    return int(sub(r'\D', '', text))  # Remove non-digit characters
+
+RESIZE_OPTIONS = ['256px', '512px (RECOMMENDED)', '1024px (No resize)']
+NOTE_ORDER_OPTIONS = ['Selection order', 'Due date', 'New card position', 'Deck', 'Random']
+IMAGE_MODEL = 'dall-e-3'
+
+# Settings that describe a generation job (as opposed to account settings)
+JOB_SETTING_KEYS = ("Sentence Field", "Term Field", "Image Field", "Resize Height", "Conflict Action", "Current Prompt",
+                    "Retry With Fallback Prompt", "Fallback Prompt")
+
+def job_settings(settings):
+    return {key: settings[key] for key in JOB_SETTING_KEYS if key in settings}
+
+# Errors that will fail every remaining note in the same way
+FATAL_ERROR_CLASSES = ("insufficient_quota", "authentication", "permission_denied")
+
+def classify_error(error):
+    code = getattr(error, "code", None)
+    status = getattr(error, "status_code", None)
+    if code == "insufficient_quota":
+        return "insufficient_quota"
+    if code == "content_policy_violation":
+        return "content_policy"
+    if status == 401:
+        return "authentication"
+    if status == 403:
+        return "permission_denied"
+    if status == 429:
+        return "rate_limit"
+    if status is not None and status >= 500:
+        return "server_error"
+    if isinstance(error, ImageDownloadError):
+        return "download"
+    if isinstance(error, (APIConnectionError, httpx.TransportError)):
+        return "connection"
+    if isinstance(error, httpx.HTTPError):
+        return "download"
+    return type(error).__name__
+
+RESUME_STATE_FILE = 'resume_state.json'
+RUN_STATS_FILE = 'run_stats.json'
+
+class CircuitBreaker:
+    def __init__(self, threshold):
+        self.threshold = max(1, int(threshold))
+        self.failed_nids = []
+        self.reason = None
+
+    @property
+    def tripped(self):
+        return self.reason is not None
+
+    def record_success(self):
+        self.failed_nids = []
+
+    def record_failure(self, nid, error_class, error_message):
+        # Only consecutive account-level errors count towards tripping the breaker
+        if error_class not in FATAL_ERROR_CLASSES:
+            return False
+        self.failed_nids.append(nid)
+        if len(self.failed_nids) >= self.threshold:
+            self.reason = error_message
+        return self.tripped
+
+FAILED_QUEUE_FILE = 'failed_queue.json'
+
+# Errors that are likely to go away on their own and can be retried automatically
+TRANSIENT_ERROR_CLASSES = ("rate_limit", "server_error", "connection", "download")
+AUTO_RETRY_DELAYS_MINUTES = [1, 5, 30, 120]
+
+class FailedNoteQueue(SharedState):
+    FILENAME = FAILED_QUEUE_FILE
+
+    def __init__(self, filename=None):
+        super().__init__(filename or state_path(FAILED_QUEUE_FILE))
+        state = read_state(self.filename, {})
+        # Job settings are stored once and referenced by id so every note does not repeat the prompt
+        self.jobs = state.get("Jobs", {})
+        self.notes = state.get("Notes", {})
+        # Notes a retry is working on right now, so the button and the automatic retries never run the same note twice
+        self.claimed = set()
+
+    def __len__(self):
+        return len(self.notes)
+
+    def record_failure(self, nid, settings, error_class, error_message, image_url=None, prompt=None):
+        job = job_settings(settings)
+        job_id = hashlib.sha1(json.dumps(job, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        with self.lock:
+            self.jobs[job_id] = job
+
+            attempts = self.notes.get(str(nid), {}).get("Attempts", 0) + 1
+            next_retry = None
+            if error_class in TRANSIENT_ERROR_CLASSES and attempts <= len(AUTO_RETRY_DELAYS_MINUTES):
+                next_retry = time.time() + AUTO_RETRY_DELAYS_MINUTES[attempts - 1] * 60
+
+            self.notes[str(nid)] = {
+                "Error Class": error_class,
+                "Error": error_message,
+                "Attempts": attempts,
+                "Last Attempt": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                "Next Retry": next_retry,
+                "Job": job_id
+            }
+            if image_url:
+                # The image is paid for; a retry downloads it again instead of generating a new one while the URL works
+                self.notes[str(nid)].update({
+                    "Image URL": image_url,
+                    "Image Prompt": prompt,
+                    "Image URL Expires": url_expiry(image_url) or time.time() + IMAGE_URL_LIFETIME
+                })
+
+    def discard(self, nid):
+        with self.lock:
+            self.notes.pop(str(nid), None)
+
+    def nids(self):
+        with self.lock:
+            return [int(nid) for nid in self.notes]
+
+    def reusable_image_url(self, nid, prompt, now=None):
+        entry = self.notes.get(str(nid), {})
+        now = time.time() if now is None else now
+        if not entry.get("Image URL") or entry.get("Image Prompt") != prompt:
+            return None
+        if entry["Image URL Expires"] - ImageClient.DOWNLOAD_EXPIRY_MARGIN <= now:
+            return None
+        return entry["Image URL"]
+
+    def due_nids(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            return [int(nid) for nid, entry in self.notes.items()
+                    if entry["Next Retry"] is not None and entry["Next Retry"] <= now and int(nid) not in self.claimed]
+
+    def next_retry_time(self):
+        with self.lock:
+            retry_times = [entry["Next Retry"] for nid, entry in self.notes.items()
+                           if entry["Next Retry"] is not None and int(nid) not in self.claimed]
+        return min(retry_times) if retry_times else None
+
+    def claim(self, nids):
+        """Returns the notes no other retry is working on, now claimed until release()."""
+        with self.lock:
+            unclaimed = [nid for nid in nids if nid not in self.claimed]
+            self.claimed.update(unclaimed)
+            return unclaimed
+
+    def release(self, nids):
+        with self.lock:
+            self.claimed.difference_update(nids)
+
+    def cancel_retry(self, nid):
+        with self.lock:
+            if str(nid) in self.notes:
+                self.notes[str(nid)]["Next Retry"] = None
+
+    def settings_by_nid(self, nids):
+        with self.lock:
+            return {nid: self.jobs.get(self.notes[str(nid)]["Job"], {}) for nid in nids if str(nid) in self.notes}
+
+    def save(self):
+        with self.lock:
+            referenced_jobs = {entry["Job"] for entry in self.notes.values()}
+            self.jobs = {job_id: job for job_id, job in self.jobs.items() if job_id in referenced_jobs}
+            write_state(self.filename, {"Jobs": self.jobs, "Notes": self.notes})
+
+REJECTED_PROMPTS_FILE = 'rejected_prompts.json'
+
+class RejectedPromptCache(SharedState):
+    FILENAME = REJECTED_PROMPTS_FILE
+
+    def __init__(self, filename=None):
+        super().__init__(filename or state_path(REJECTED_PROMPTS_FILE))
+        self.entries = read_state(self.filename, {})
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def prompt_key(prompt, model=IMAGE_MODEL):
+        return hashlib.sha256(f"{model}\n{prompt}".encode('utf-8')).hexdigest()
+
+    def contains(self, prompt, model=IMAGE_MODEL):
+        return self.prompt_key(prompt, model) in self.entries
+
+    def record_rejection(self, nid, prompt, error_message, model=IMAGE_MODEL):
+        with self.lock:
+            self.entries[self.prompt_key(prompt, model)] = {
+                "Note ID": nid,
+                "Model": model,
+                "Prompt": prompt,
+                "Error": error_message,
+                "Rejected": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+
+    def forget(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def save(self):
+        with self.lock:
+            write_state(self.filename, self.entries)
+
+FALLBACK_NOTES_FILE = 'fallback_notes.json'
+
+class FallbackNoteStore(SharedState):
+    FILENAME = FALLBACK_NOTES_FILE
+
+    def __init__(self, filename=None):
+        super().__init__(filename or state_path(FALLBACK_NOTES_FILE))
+        self.notes = read_state(self.filename, {})
+
+    def succeeded(self, nid):
+        return self.notes.get(str(nid), {}).get("Succeeded", False)
+
+    def record_outcome(self, nid, template, succeeded):
+        with self.lock:
+            self.notes[str(nid)] = {
+                "Template": template,
+                "Succeeded": succeeded,
+                "Updated": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+
+    def save(self):
+        with self.lock:
+            write_state(self.filename, self.notes)
+
+DOWNLOAD_ORIGINS_FILE = 'download_origins.json'
+
+class DownloadOrigins(SharedState):
+    """Hosts images were downloaded from in earlier runs, so the warm-up can connect to them too."""
+
+    FILENAME = DOWNLOAD_ORIGINS_FILE
+    MAX_ORIGINS = 3
+
+    def __init__(self, filename=None):
+        super().__init__(filename or state_path(DOWNLOAD_ORIGINS_FILE))
+        self.origins = read_state(self.filename, [])
+
+    def record(self, origins):
+        # Most recent first; the CDN host rarely changes, so this is usually one entry
+        with self.lock:
+            updated = list(dict.fromkeys(list(origins) + self.origins))[:self.MAX_ORIGINS]
+            if updated != self.origins:
+                self.origins = updated
+                write_state(self.filename, self.origins)
+
+class NoteNotFoundError(Exception):
+    """A note that was deleted after it was queued, saved for resume or recorded as failed."""
+
+class CollectionAdapter:
+    """The collection operations the engine needs. Wraps Anki's Collection, or anything with the same methods.
+
+    With run_on_main (Anki's mw.taskman.run_on_main), note updates are applied on the main thread without an
+    undo entry and the worker waits for them. Used for images added in the background, so the user's own
+    undo still undoes their last action. The note is read again there and only its image field is set, so
+    edits the user made while the image was generated are kept.
+
+    With commit_chunk_size above 1, images are held back and saved together in one update_notes call once
+    that many are waiting, or when flush() is called; with None, only when flush() is called. The notes are read again then as well, and notes deleted
+    in the meantime are left out.
+    """
+
+    # Anki runs queued main-thread work within a moment; a worker stops waiting after this long
+    MAIN_THREAD_TIMEOUT = 60.0
+
+    def __init__(self, col, run_on_main=None, commit_chunk_size=1):
+        self.col = col
+        self.run_on_main = run_on_main
+        self.commit_chunk_size = commit_chunk_size
+        self.pending_images = []
+
+    def get_note(self, nid):
+        try:
+            return self.col.get_note(nid)
+        except Exception as e:
+            # Anki raises anki.errors.NotFoundError (not importable here), stand-in collections a KeyError
+            if isinstance(e, KeyError) or type(e).__name__ == "NotFoundError":
+                raise NoteNotFoundError(f"Note {nid} not found") from e
+            raise
+
+    def add_image(self, note, image_filename, settings):
+        if self.commit_chunk_size is None or self.commit_chunk_size > 1:
+            self.pending_images.append((note.id, image_filename, settings))
+            if self.commit_chunk_size is not None and len(self.pending_images) >= self.commit_chunk_size:
+                self.flush()
+        elif self.run_on_main is None:
+            set_image_field(note, image_filename, settings)
+            self.col.update_note(note)
+        else:
+            self.apply_on_main(lambda: self.add_image_on_main(note.id, image_filename, settings))
+
+    def add_image_on_main(self, nid, image_filename, settings):
+        note = self.get_note(nid)
+        set_image_field(note, image_filename, settings)
+        self.col.update_note(note, skip_undo_entry=True)
+
+    def flush(self):
+        images, self.pending_images = self.pending_images, []
+        if not images:
+            return
+        if self.run_on_main is None:
+            self.col.update_notes(self.notes_with_images(images))
+        else:
+            self.apply_on_main(lambda: self.col.update_notes(self.notes_with_images(images), skip_undo_entry=True))
+
+    def notes_with_images(self, images):
+        notes = []
+        for nid, image_filename, settings in images:
+            try:
+                note = self.get_note(nid)
+            except NoteNotFoundError:
+                print(f'Note {nid} was deleted before its image was saved')
+                continue
+            set_image_field(note, image_filename, settings)
+            notes.append(note)
+        return notes
+
+    def apply_on_main(self, operation):
+        done = threading.Event()
+        abandoned = threading.Event()
+        lock = threading.Lock()
+        errors = []
+
+        def apply():
+            with lock:
+                if abandoned.is_set():
+                    return  # The worker gave up waiting and reported the note as failed
+                try:
+                    operation()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    done.set()
+        self.run_on_main(apply)
+        if not done.wait(self.MAIN_THREAD_TIMEOUT):
+            with lock:
+                if not done.is_set():
+                    abandoned.set()
+                    raise TimeoutError("The note update was not applied on the main thread in time")
+        if errors:
+            raise errors[0]
+
+    def media_dir(self):
+        return self.col.media.dir()
+
+    def card_schedule(self, nids):
+        """(nid, did, odid, queue, due, odue) of every card of the given notes, in one query."""
+        ids = ",".join(str(int(nid)) for nid in nids)
+        return self.col.db.all(f"select nid, did, odid, queue, due, odue from cards where nid in ({ids})")
+
+    def today(self):
+        # Days since the collection was created, what review due dates count in
+        return self.col.sched.today
+
+    def deck_name(self, did):
+        return self.col.decks.name(did)
+
+# Settings a client is built from; a client is reused across runs as long as these stay the same
+CLIENT_SETTING_KEYS = ("API Key", "Base URL", "Generation Client", "Trace Connections")
+WARM_UP_TIMEOUT = httpx.Timeout(15.0, connect=10.0)
+
+class ImageDownloadError(Exception):
+    """An image download that did not produce a valid image."""
+
+# Generated image URLs are signed and work for an hour; "se" in the query is when the signature expires
+IMAGE_URL_LIFETIME = 3600
+
+def url_expiry(image_url):
+    """Unix time at which a signed image URL stops working, None if the URL doesn't say."""
+    value = parse_qs(urlsplit(image_url).query).get("se", [None])[0]
+    if value is None:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+def verify_image(image_data):
+    # Catches a truncated or corrupt body that still came with a success status
+    try:
+        with Image.open(BytesIO(image_data)) as image:
+            image.verify()
+    except Exception as e:
+        raise ImageDownloadError(f"Downloaded image is not valid ({len(image_data)} bytes): {e}") from e
+
+def parse_content_range(value):
+    # "bytes 200-1023/1024" -> (200, 1024); the total may be "*"
+    try:
+        unit, _, byte_range = value.partition(' ')
+        first, _, total = byte_range.partition('/')
+        return int(first.split('-')[0]), int(total) if total.isdigit() else None
+    except (AttributeError, ValueError):
+        return None, None
+
+class PartialDownload:
+    """The part of an image received so far, and what is needed to resume it with a Range request."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.total = None
+        self.resumable = False
+        # ETag or Last-Modified, sent as If-Range so a resumed body is known to be from the same file
+        self.validator = None
+
+    def clear(self):
+        self.data.clear()
+        self.total = None
+
+class ImageClient:
+    """Generation requests and image downloads, sharing one connection pool."""
+
+    DEFAULT_BASE_URL = 'https://api.openai.com/v1'
+    DOWNLOAD_ATTEMPTS = 6
+    DOWNLOAD_RETRY_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+    # No download attempt is started this close to the URL's expiry
+    DOWNLOAD_EXPIRY_MARGIN = 5.0
+
+    def __init__(self, settings):
+        self.open_pool(settings)
+        base_url = settings["Base URL"]
+        self.openai = OpenAI(api_key=settings["API Key"], base_url=base_url if base_url else None, http_client=self.http_client)
+
+    def open_pool(self, settings):
+        self.settings = {key: settings.get(key) for key in CLIENT_SETTING_KEYS}
+        self.base_url = (settings["Base URL"] or self.DEFAULT_BASE_URL).rstrip('/')
+        self.headers = {"Authorization": f"Bearer {settings['API Key']}"}
+        self.download_origins = set()
+        self.connection_tracer = ConnectionTracer(log_request_trace) if settings.get("Trace Connections") else None
+        self.http_client = create_http_client(self.connection_tracer)
+
+    def matches(self, settings):
+        return self.settings == {key: settings.get(key) for key in CLIENT_SETTING_KEYS}
+
+    def warm_up(self, download_origins=(), validate_key=False):
+        """Opens pooled connections to the API host and the given download hosts before the first note needs them.
+
+        With validate_key, lists the models with the API key (a free call) and returns the error message
+        if the key was rejected. Returns None otherwise; other failures only mean the run connects itself.
+        """
+        rejection = None
+        # RuntimeError: the client was closed meanwhile because the settings changed
+        try:
+            if validate_key:
+                response = self.http_client.get(self.base_url + '/models', headers=self.headers, timeout=WARM_UP_TIMEOUT)
+                if response.status_code in (401, 403):
+                    rejection = ImageAPIError.from_response(response)
+            else:
+                # Any answer will do, the request is only made to resolve the host and complete TCP and TLS
+                self.http_client.head(self.base_url, timeout=WARM_UP_TIMEOUT)
+        except (httpx.HTTPError, RuntimeError) as e:
+            debug_log(f"Connection warm-up to {self.base_url} failed: {e}", stage="warm_up")
+        api_origin = self.origin(self.base_url)
+        for origin in download_origins:
+            if origin == api_origin:
+                continue
+            try:
+                self.http_client.head(origin, timeout=WARM_UP_TIMEOUT)
+            except (httpx.HTTPError, RuntimeError) as e:
+                debug_log(f"Connection warm-up to {origin} failed: {e}", stage="warm_up")
+        return str(rejection) if rejection is not None else None
+
+    @staticmethod
+    def origin(url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def generate(self, prompt, run_progress=None):
+        # Errors are left to the caller so they can be classified per note
+        raw_response = self.openai.images.with_raw_response.generate(
+            model=IMAGE_MODEL,
+            size='1024x1024',
+            prompt=prompt
+        )
+        # The raw response exposes the rate limit headers for the progress display
+        if run_progress is not None:
+            run_progress.record_rate_limit(raw_response.headers)
+        return raw_response.parse().data[0].url
+
+    def download(self, image_url):
+        """Downloads a generated image, retrying with backoff and resuming partial bodies while the URL is valid."""
+        expires = url_expiry(image_url)
+        partial = PartialDownload()
+        for attempt in range(self.DOWNLOAD_ATTEMPTS):
+            retry_headers = None
+            try:
+                self.fetch_image(image_url, partial)
+                image_data = bytes(partial.data)
+                verify_image(image_data)
+                self.download_origins.add(self.origin(image_url))
+                return image_data
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in self.DOWNLOAD_RETRY_STATUS_CODES:
+                    raise
+                error, retry_headers = e, e.response.headers
+            except httpx.TransportError as e:
+                error = e
+            except ImageDownloadError as e:
+                # Whatever arrived is not usable, start over
+                error = e
+                partial.clear()
+            if attempt == self.DOWNLOAD_ATTEMPTS - 1:
+                raise error
+            delay = self.retry_delay(attempt, retry_headers)
+            if expires is not None and time.time() + delay > expires - self.DOWNLOAD_EXPIRY_MARGIN:
+                raise ImageDownloadError(f"Image URL expired before the download succeeded: {error}") from error
+            debug_log(f"Download attempt {attempt + 1} failed, retrying in {delay:.1f}s "
+                      f"with {len(partial.data)} bytes kept: {error}", stage="download")
+            METRICS.inc("download_retries_total")
+            time.sleep(delay)
+
+    def fetch_image(self, image_url, partial):
+        # Range offsets count body bytes as sent, so ask for no content encoding
+        headers = {"Accept-Encoding": "identity"}
+        resume_from = len(partial.data) if partial.resumable else 0
+        if resume_from and resume_from == partial.total:
+            return  # The body was complete, the connection failed after it
+        if resume_from:
+            headers["Range"] = f"bytes={resume_from}-"
+            if partial.validator:
+                headers["If-Range"] = partial.validator
+        with self.http_client.stream("GET", image_url, headers=headers) as response:
+            response.raise_for_status()
+            if response.status_code == 206:
+                start, partial.total = parse_content_range(response.headers.get("content-range"))
+                if start != resume_from:
+                    partial.resumable = False
+                    partial.clear()
+                    raise ImageDownloadError(f"Server resumed at byte {start} instead of {resume_from}")
+                METRICS.inc("download_resumed_bytes_total", resume_from)
+            else:
+                # A full body: the first attempt, or the server ignored the Range because the file changed
+                partial.clear()
+                content_length = response.headers.get("content-length")
+                partial.total = int(content_length) if content_length and content_length.isdigit() else None
+                partial.validator = response.headers.get("etag") or response.headers.get("last-modified")
+            partial.resumable = response.headers.get("accept-ranges") == "bytes"
+            for chunk in response.iter_bytes():
+                partial.data.extend(chunk)
+        if partial.total is not None and len(partial.data) != partial.total:
+            raise ImageDownloadError(f"Download ended after {len(partial.data)} of {partial.total} bytes")
+
+    def close(self):
+        self.http_client.close()
+
+    @staticmethod
+    def retry_delay(attempt, headers=None):
+        headers = headers or {}
+        retry_after = None
+        try:
+            if "retry-after-ms" in headers:
+                retry_after = float(headers["retry-after-ms"]) / 1000
+            elif "retry-after" in headers:
+                retry_after = float(headers["retry-after"])
+        except ValueError:
+            pass
+        if retry_after is not None and 0 < retry_after <= 60:
+            return retry_after
+        # Exponential backoff with jitter, as in the SDK
+        return min(0.5 * 2 ** attempt, 8.0) * (1 - 0.25 * random.random())
+
+class ImageAPIError(Exception):
+    """An error answer from the images API on the lean path, with the attributes classify_error reads."""
+
+    def __init__(self, message, status_code, code=None, request_id=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+        self.request_id = request_id
+
+    @staticmethod
+    def error_body(response):
+        try:
+            return response.json().get("error") or {}
+        except ValueError:
+            return {}
+
+    @classmethod
+    def from_response(cls, response):
+        error = cls.error_body(response)
+        message = error.get("message") or response.text
+        return cls(f"Error code: {response.status_code} - {message}", response.status_code,
+                   code=error.get("code"), request_id=response.headers.get("x-request-id"))
+
+# Either kind of client raises one of these for an error answer from the API
+API_ERRORS = (OpenAIError, ImageAPIError)
+
+class LeanImageClient(ImageClient):
+    """Posts generation requests directly on the shared httpx client and reads only the image URL.
+
+    Skips the SDK's request building and pydantic response models. Retries follow the SDK's rules:
+    up to MAX_RETRIES for timeouts, conflicts, rate limits and server errors, honouring retry-after.
+    """
+
+    MAX_RETRIES = 2
+    RETRY_STATUS_CODES = (408, 409, 429)
+    # Image generation can take a while, the SDK allows 10 minutes per request
+    REQUEST_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+
+    def __init__(self, settings):
+        self.open_pool(settings)
+        self.url = self.base_url + '/images/generations'
+
+    def generate(self, prompt, run_progress=None):
+        body = {"model": IMAGE_MODEL, "prompt": prompt, "size": '1024x1024', "n": 1}
+        for attempt in range(self.MAX_RETRIES + 1):
+            last_attempt = attempt == self.MAX_RETRIES
+            try:
+                response = self.http_client.post(self.url, json=body, headers=self.headers, timeout=self.REQUEST_TIMEOUT)
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+                time.sleep(self.retry_delay(attempt))
+                continue
+            if run_progress is not None:
+                run_progress.record_rate_limit(response.headers)
+            if response.is_success:
+                return json.loads(response.content)["data"][0]["url"]
+            if last_attempt or not self.should_retry(response):
+                raise ImageAPIError.from_response(response)
+            time.sleep(self.retry_delay(attempt, response.headers))
+
+    def should_retry(self, response):
+        # Waiting does not bring back credit, so the circuit breaker gets to see this at once
+        if response.status_code == 429 and ImageAPIError.error_body(response).get("code") == "insufficient_quota":
+            return False
+        should_retry_header = response.headers.get("x-should-retry")
+        if should_retry_header in ("true", "false"):
+            return should_retry_header == "true"
+        return response.status_code in self.RETRY_STATUS_CODES or response.status_code >= 500
+
+IMAGE_CLIENTS = {"sdk": ImageClient, "lean": LeanImageClient}
+
+def create_image_client(settings):
+    return IMAGE_CLIENTS.get(settings.get("Generation Client", "sdk"), ImageClient)(settings)
+
+# Card queues as stored in Anki's cards table
+QUEUE_NEW, QUEUE_LEARNING, QUEUE_REVIEW, QUEUE_DAY_LEARNING, QUEUE_PREVIEW = 0, 1, 2, 3, 4
+
+def card_urgency(queue, due, today):
+    """Sort key for a card: learning first, then reviews by due date, then new cards by position, then the rest."""
+    if queue in (QUEUE_LEARNING, QUEUE_PREVIEW):
+        return (0, 0)  # Due today, the due value is a timestamp
+    if queue in (QUEUE_REVIEW, QUEUE_DAY_LEARNING):
+        return (1, due - today)
+    if queue == QUEUE_NEW:
+        return (2, due)
+    return (3, 0)  # Suspended or buried
+
+def order_notes(collection, nids, order):
+    """Orders the notes by one of NOTE_ORDER_OPTIONS (an index) so the images needed soonest come first."""
+    nids = list(nids)
+    if not order or not nids:
+        return nids
+    if NOTE_ORDER_OPTIONS[order] == 'Random':
+        random.shuffle(nids)
+        return nids
+
+    today = collection.today()
+    by_position = NOTE_ORDER_OPTIONS[order] == 'New card position'
+    keys = {}
+    for nid, did, odid, queue, due, odue in collection.card_schedule(nids):
+        if odid:
+            # Cards in a filtered deck are ordered by their home deck and original due date
+            did, due = odid, odue
+        urgency = card_urgency(queue, due, today)
+        if by_position:
+            urgency = (0, due) if queue == QUEUE_NEW else (1,) + urgency
+        # A note is as urgent as its most urgent card
+        if nid not in keys or urgency < keys[nid][1]:
+            keys[nid] = (did, urgency)
+
+    # Notes without cards can't be reviewed, they go last
+    no_cards = (None, (5, 0))
+    if NOTE_ORDER_OPTIONS[order] == 'Deck':
+        deck_names = {did: collection.deck_name(did) for did, _ in keys.values()}
+
+        def deck_key(nid):
+            did, urgency = keys.get(nid, no_cards)
+            return (did is None, deck_names.get(did, ''), urgency)
+        return sorted(nids, key=deck_key)
+    return sorted(nids, key=lambda nid: keys.get(nid, no_cards)[1])
+
+def render_prompt(template, note, settings):
+    term_text = note[settings["Term Field"]]
+    # Notes without a sentence use the term in its place
+    sentence_text = note[settings["Sentence Field"]] or term_text
+    return template.format(term=term_text, sentence=sentence_text)
+
+def resize_image(image_data, resize_height):
+    if resize_height == 2:  # '1024px (No resize)'
+        return image_data
+    image = Image.open(BytesIO(image_data))
+    width, height = image.size
+
+    # Extract the numeric value for resizing
+    new_height = extract_numeric_value(RESIZE_OPTIONS[resize_height])
+    new_width = int(new_height * width / height)
+    image = image.resize((new_width, new_height), Image.LANCZOS)
+
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def write_media_file(media_dir, image_data):
+    # Generate a unique filename
+    image_filename = f"{base64.urlsafe_b64encode(os.urandom(6)).decode('utf-8')}.png"
+    with open(os.path.join(media_dir, image_filename), 'wb') as image_file:
+        image_file.write(image_data)
+    return image_filename
+
+def set_image_field(note, image_filename, settings):
+    current_image_field = note[settings["Image Field"]]
+    if settings["Conflict Action"] == 0:  # Overwrite
+        note[settings["Image Field"]] = f"<img src='{image_filename}' />"
+    elif settings["Conflict Action"] == 1:  # Add
+        note[settings["Image Field"]] += f" <img src='{image_filename}' />"
+    elif settings["Conflict Action"] == 2:  # Skip
+        if current_image_field.strip() == "":
+            note[settings["Image Field"]] = f"<img src='{image_filename}' />"
+    note.add_tag('ai-img')
+
+class NoteResult:
+    SUCCESS = "success"
+    ERROR = "error"
+    SKIPPED = "skipped"  # Prompt was rejected by the content filter before
+
+    def __init__(self, nid, status, image_filename=None, error_class=None, error=None, stage=None, durations=None):
+        self.nid = nid
+        self.status = status
+        self.image_filename = image_filename
+        self.error_class = error_class
+        self.error = error
+        self.stage = stage
+        self.durations = durations or {}
+
+class GenerationRun:
+    """Runs the pipeline over a list of notes: prompt, generation, download, resize, media file, note update."""
+
+    def __init__(self, collection, image_client, nids, settings, note_settings=None, on_tripped=None, on_result=None,
+                 before_write=None):
+        self.collection = collection
+        self.image_client = image_client
+        self.nids = nids
+        # Each run keeps its own copy so that resumed runs use their original job settings
+        self.settings = dict(settings)
+        # Optional per-note job settings, used when retrying notes that failed in different jobs
+        self.note_settings = {nid: dict(self.settings, **job) for nid, job in (note_settings or {}).items()}
+        self.on_tripped = on_tripped  # Called with the breaker message and the number of notes saved for resume
+        self.on_result = on_result  # Called with the NoteResult of every processed note
+        # Called before a note's media file and note are saved; may block (sync), returns False to not save
+        self.before_write = before_write
+        self.run_progress = RunProgress(len(nids))
+        self.profiler = RunProfiler.from_settings(self.settings, ADDON_DIR)
+        self.stats = RunStats()
+        self._is_running = True
+
+    def run(self):
+        # Must be called from the thread that does the work, see RunProfiler.start
+        self.profiler.start()
+        try:
+            return self.process_notes()
+        finally:
+            self.profiler.stop()
+
+    def cancel(self):
+        self._is_running = False
+
+    @property
+    def cancelled(self):
+        return not self._is_running
+
+    def open_state(self):
+        # State shared with other runs, process_note needs it loaded
+        self.breaker = CircuitBreaker(self.settings.get("Circuit Breaker Threshold", 3))
+        self.failed_queue = FailedNoteQueue.shared()
+        self.rejected_prompts = RejectedPromptCache.shared()
+        self.fallback_notes = FallbackNoteStore.shared()
+
+    def save_state(self):
+        self.failed_queue.save()
+        self.rejected_prompts.save()
+        self.fallback_notes.save()
+
+    def process_notes(self):
+        counts = {NoteResult.SUCCESS: 0, NoteResult.ERROR: 0, NoteResult.SKIPPED: 0}
+        order = self.settings.get("Note Order", 0)
+        if order:
+            order_start = time.perf_counter()
+            self.nids = order_notes(self.collection, self.nids, order)
+            run_log.log_event(f"Ordered {len(self.nids)} notes by {NOTE_ORDER_OPTIONS[order]}", stage="run",
+                              duration=round(time.perf_counter() - order_start, 4))
+        self.open_state()
+
+        for index, nid in enumerate(self.nids):
+            if not self._is_running:
+                break
+
+            result = self.process_note(nid, self.note_settings.get(nid, self.settings))
+            counts[result.status] += 1
+            if self.on_result is not None:
+                self.on_result(result)
+            self.profiler.note_done(index + 1)
+
+            if self.breaker.tripped:
+                self.save_resume_state(self.nids[index + 1:])
+                break
+
+        self.save_state()
+        if self.image_client.connection_tracer is not None:
+            self.stats.connections = self.image_client.connection_tracer.to_dict()
+        self.stats.finish()
+        self.stats.save(state_path(RUN_STATS_FILE))
+        write_metrics_now()
+        success_count, error_count, skipped_count = counts[NoteResult.SUCCESS], counts[NoteResult.ERROR], counts[NoteResult.SKIPPED]
+        run_log.log_event(f"Finished run: {success_count} successes, {error_count} errors, {skipped_count} skipped",
+                          stage="run", data={"stats": self.stats.to_dict()})
+        return success_count, error_count, skipped_count
+
+    def process_note(self, nid, settings):
+        note_start = time.perf_counter()
+        timer = StageTimer()
+        self.run_progress.note_started()
+        stage = "prompt"
+        prompt = None
+        image_url = None
+        try:
+            with timer.stage("prompt"):
+                note = self.collection.get_note(nid)
+                prompt = render_prompt(settings["Current Prompt"], note, settings)
+
+                fallback_prompt = None
+                if settings.get("Retry With Fallback Prompt"):
+                    fallback_prompt = render_prompt(settings["Fallback Prompt"], note, settings)
+                    # Notes that are already known to need the fallback go straight to it
+                    if self.fallback_notes.succeeded(nid) or self.rejected_prompts.contains(prompt):
+                        prompt, fallback_prompt = fallback_prompt, None
+
+            # Don't pay for a request that is known to be rejected by the content filter
+            if settings.get("Skip Rejected Prompts", True) and self.rejected_prompts.contains(prompt):
+                run_log.log_event(f"Skipped note {nid}, prompt was rejected before", nid=nid, stage="prompt")
+                self.run_progress.note_finished()
+                return NoteResult(nid, NoteResult.SKIPPED, stage="prompt")
+            debug_log(f"Rendered prompt: {prompt}", nid=nid, stage="prompt")
+
+            stage = "generate"
+            image_url = self.failed_queue.reusable_image_url(nid, prompt)
+            if image_url:
+                run_log.log_event(f"Downloading the image generated for note {nid} in an earlier attempt", nid=nid, stage="generate")
+                METRICS.inc("images_reused_total")
+            else:
+                with timer.stage("api"):
+                    image_url = self.generate_with_fallback(nid, settings, prompt, fallback_prompt)
+            if not image_url:
+                raise ValueError("Invalid image URL returned")
+
+            # Download, resize and save the image to the media folder
+            stage = "save"
+            with timer.stage("download"):
+                image_data = self.image_client.download(image_url)
+            with timer.stage("image"):
+                image_data = resize_image(image_data, settings["Resize Height"])
+            if self.before_write is not None and not self.before_write():
+                raise RuntimeError("Stopped before the image was saved")
+            with timer.stage("write"):
+                image_filename = write_media_file(self.collection.media_dir(), image_data)
+            METRICS.inc("bytes_written_total", len(image_data))
+
+            # Update the note with the new image
+            stage = "update"
+            with timer.stage("update"):
+                self.collection.add_image(note, image_filename, settings)
+        except NoteNotFoundError as e:
+            return self.handle_missing_note(nid, e, note_start)
+        except (httpx.HTTPError, ValueError, ImageDownloadError, *API_ERRORS) as e:
+            return self.handle_error(nid, settings, e, f"Error processing note {nid}: {e}", prompt, stage, note_start,
+                                     image_url)
+        except Exception as e:
+            return self.handle_error(nid, settings, e, f"Unhandled error processing note {nid}: {e}", prompt, stage, note_start,
+                                     image_url)
+
+        self.breaker.record_success()
+        self.failed_queue.discard(nid)
+        timer.durations["total"] = time.perf_counter() - note_start
+        self.stats.record_note(timer)
+        self.run_progress.note_finished(succeeded=True)
+        run_log.log_event(f"Processed note {nid}", nid=nid, stage="done",
+                          duration=round(timer.durations["total"], 3),
+                          data={"stages": {name: round(seconds, 4) for name, seconds in timer.durations.items()}})
+        return NoteResult(nid, NoteResult.SUCCESS, image_filename=image_filename, stage="done", durations=timer.durations)
+
+    def generate_with_fallback(self, nid, settings, prompt, fallback_prompt):
+        try:
+            return self.image_client.generate(prompt, self.run_progress)
+        except API_ERRORS as e:
+            if fallback_prompt is None or classify_error(e) != "content_policy":
+                raise
+            self.rejected_prompts.record_rejection(nid, prompt, str(e))
+            log_error(f"Prompt for note {nid} was rejected, retrying with the fallback prompt: {e}",
+                      nid=nid, stage="generate", error_class="content_policy", request_id=getattr(e, "request_id", None))
+
+        # Retry once with the softer template and remember how it went for later runs
+        try:
+            image_url = self.image_client.generate(fallback_prompt, self.run_progress)
+        except API_ERRORS as e:
+            self.fallback_notes.record_outcome(nid, settings["Fallback Prompt"], False)
+            if classify_error(e) == "content_policy":
+                self.rejected_prompts.record_rejection(nid, fallback_prompt, str(e))
+            raise
+        self.fallback_notes.record_outcome(nid, settings["Fallback Prompt"], True)
+        return image_url
+
+    def handle_error(self, nid, settings, error, error_message, prompt=None, stage=None, note_start=None, image_url=None):
+        print(error_message)
+        error_class = classify_error(error)
+        if error_class == "content_policy" and prompt is not None:
+            # Rejected prompts are reviewed from their own list rather than retried blindly
+            self.rejected_prompts.record_rejection(nid, prompt, str(error))
+            self.failed_queue.discard(nid)
+            retry_count = 0
+        else:
+            self.failed_queue.record_failure(nid, settings, error_class, str(error), image_url, prompt)
+            retry_count = self.failed_queue.notes[str(nid)]["Attempts"] - 1
+        self.stats.record_error(error_class)
+        self.run_progress.note_finished(error_class=error_class)
+        log_error(error_message, nid=nid, stage=stage, error_class=error_class,
+                  request_id=getattr(error, "request_id", None), retry_count=retry_count,
+                  duration=round(time.perf_counter() - note_start, 3) if note_start is not None else None)
+        self.breaker.record_failure(nid, error_class, str(error))
+        return NoteResult(nid, NoteResult.ERROR, error_class=error_class, error=str(error), stage=stage)
+
+    def handle_missing_note(self, nid, error, note_start):
+        # Nothing to retry: the note leaves the failed queue instead of being recorded again
+        self.failed_queue.discard(nid)
+        self.stats.record_error("note_missing")
+        self.run_progress.note_finished(error_class="note_missing")
+        log_error(f"Skipped note {nid}, it was deleted", nid=nid, stage="prompt", error_class="note_missing",
+                  duration=round(time.perf_counter() - note_start, 3))
+        return NoteResult(nid, NoteResult.ERROR, error_class="note_missing", error=str(error), stage="prompt")
+
+    def save_resume_state(self, unprocessed_nids):
+        breaker = self.breaker
+        # Stop dispatching and keep every note that was not successfully processed for a later resume
+        remaining_nids = breaker.failed_nids + list(unprocessed_nids)
+        # Notes saved for resume should not also be retried from the failed queue
+        for failed_nid in breaker.failed_nids:
+            self.failed_queue.discard(failed_nid)
+        write_state(state_path(RESUME_STATE_FILE), {
+            "Created": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "Reason": breaker.reason,
+            "Settings": job_settings(self.settings),
+            # Notes retried from the failed queue keep the job they originally failed in
+            "Note Settings": {str(nid): job_settings(self.note_settings[nid])
+                              for nid in remaining_nids if nid in self.note_settings},
+            "Note IDs": remaining_nids
+        })
+        log_error(f"Circuit breaker tripped, {len(remaining_nids)} notes saved for resume: {breaker.reason}", stage="run")
+        if self.on_tripped is not None:
+            self.on_tripped(breaker.reason, len(remaining_nids))
+
+class BackgroundGenerator:
+    """What the background workers (review.py, new_notes.py, retries.py) share: the saved settings, one image client and
+    one circuit breaker kept across notes, and note updates applied on Anki's main thread. Takes Anki's mw,
+    and notify, which is called on the main thread with a message for the user."""
+
+    # How long closing the profile waits for a worker to save the note or batch it is working on
+    CLOSE_TIMEOUT = 15.0
+
+    def __init__(self, mw, notify=None):
+        self.mw = mw
+        self.notify = notify
+        self.image_client = None
+        self.breaker = None
+        self.main_tasks = None  # Set while the profile closes, see finish()
+        self.closed = False
+
+    def run_on_main(self, task):
+        if self.closed:
+            raise RuntimeError("The profile was closed before the note was saved")
+        main_tasks = self.main_tasks
+        if main_tasks is not None:
+            main_tasks.put(task)
+        else:
+            self.mw.taskman.run_on_main(task)
+
+    def finish(self, worker):
+        """Called on the main thread when the profile closes, once the worker was told to stop. The main thread
+        is busy closing until then, so the worker's note updates are run here, before the collection closes.
+        After CLOSE_TIMEOUT the worker is left to stop on its own, and its later updates are refused."""
+        main_tasks = self.main_tasks = Queue()
+        deadline = time.monotonic() + self.CLOSE_TIMEOUT
+        while worker.is_alive() and time.monotonic() < deadline:
+            try:
+                task = main_tasks.get(timeout=0.05)
+            except Empty:
+                # Keeps Anki's window responding while it waits
+                self.mw.app.processEvents()
+                continue
+            task()
+        self.closed = True
+        self.main_tasks = None
+        # Updates queued just before, while the collection is still open
+        while not main_tasks.empty():
+            main_tasks.get()()
+
+    def settings(self):
+        settings = dict(load_settings())
+        settings["Current Prompt"] = settings.get("Current Prompt") or settings.get("Default Prompt", "")
+        return settings
+
+    def needs_image(self, note, settings):
+        # Only notes with the configured fields (another note type may not have them) and no image yet
+        fields = (settings.get("Term Field"), settings.get("Sentence Field"), settings.get("Image Field"))
+        return all(field in note.keys() for field in fields) and not note[settings["Image Field"]].strip()
+
+    def engine(self, nids, settings, commit_chunk_size=1, before_write=None, note_settings=None):
+        configure_run(settings)
+        if self.breaker is None:
+            self.breaker = CircuitBreaker(settings.get("Circuit Breaker Threshold", 3))
+        if self.image_client is None or not self.image_client.matches(settings):
+            if self.image_client is not None:
+                self.image_client.close()
+            self.image_client = create_image_client(settings)
+
+        collection = CollectionAdapter(self.mw.col, run_on_main=self.run_on_main,
+                                       commit_chunk_size=commit_chunk_size)
+        engine = GenerationRun(collection, self.image_client, nids, settings, note_settings, before_write=before_write)
+        engine.open_state()
+        engine.breaker = self.breaker
+        return engine
+
+    def stop_if_tripped(self, what):
+        """Returns whether the breaker tripped, after telling the user why the worker stops."""
+        if self.breaker is None or not self.breaker.tripped:
+            return False
+        message = f"Stopped {what}: {self.breaker.reason}"
+        log_error(message, stage="background")
+        if self.notify is not None and not self.closed:
+            self.run_on_main(lambda: self.notify(message))
+        return True
+
+    def close(self):
+        if self.image_client is not None:
+            self.image_client.close()
@@ -0,0 +1,340 @@
+"""Local stand-in for the OpenAI images API, for zero-cost test and benchmark runs.
+
+Run it with the Python that ships with Anki or any Python 3.9+ (standard library only):
+
+    python devserver.py --port 8765 --api-latency lognormal:2.5,0.3 --error-429 0.05
+
+and set the addon's "Base URL" to http://127.0.0.1:8765/v1 (any API key is accepted unless
+--api-key is given). Generated images are served by the same server, so both the API call
+and the image download go through the normal code paths.
+"""
+import json
+import math
+import time
+import uuid
+import zlib
+import base64
+import random
+import struct
+import argparse
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+IMAGE_VARIANTS = 8
+IMAGE_MODEL_ID = 'dall-e-3'
+
+def parse_latency(spec):
+    """Parse "fixed:S", "uniform:MIN,MAX", "normal:MEAN,STDDEV" or "lognormal:MEDIAN,SIGMA" (seconds)."""
+    kind, _, args = spec.partition(':')
+    values = [float(value) for value in args.split(',')] if args else []
+    if kind == 'fixed' and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == 'uniform' and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'normal' and len(values) == 2:
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == 'lognormal' and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1]) if values[0] > 0 else 0.0
+    raise argparse.ArgumentTypeError(f"Invalid latency distribution: {spec}")
+
+def make_png(width, height, variant, noise_bits, rng):
+    # A diagonal gradient tinted per variant with random low bits on top, so the PNG compresses
+    # about as badly as a real DALL-E image (a few MB at 1024x1024) instead of to a few KB
+    tint = ((variant * 67) % 256, (variant * 151) % 256, (variant * 29) % 256)
+    stride = width * 3
+    pattern = bytes((((i // 24) + tint[i % 3]) & 0xFF) for i in range(stride + height * 3))
+    pixels = b''.join(pattern[y * 3:y * 3 + stride] for y in range(height))
+    if noise_bits:
+        mask = (1 << noise_bits) - 1
+        noise = rng.randbytes(len(pixels)).translate(bytes(value & mask for value in range(256)))
+        # XOR through big integers keeps this fast without numpy
+        pixels = (int.from_bytes(pixels, 'big') ^ int.from_bytes(noise, 'big')).to_bytes(len(pixels), 'big')
+    raw = b''.join(b'\x00' + pixels[y * stride:(y + 1) * stride] for y in range(height))
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body) & 0xFFFFFFFF)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b'')
+
+class RateLimiter:
+    def __init__(self, requests_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.window = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Returns (allowed, remaining, seconds until a slot frees up)."""
+        now = time.monotonic()
+        with self.lock:
+            while self.window and now - self.window[0] >= 60:
+                self.window.popleft()
+            reset = 60 - (now - self.window[0]) if self.window else 0.0
+            if len(self.window) >= self.requests_per_minute:
+                return False, 0, reset
+            self.window.append(now)
+            return True, self.requests_per_minute - len(self.window), reset
+
+class StandInConfig:
+    def __init__(self, api_latency='fixed:0', cdn_latency='fixed:0', error_429=0.0, error_5xx=0.0,
+                 error_policy=0.0, policy_words=(), requests_per_minute=0, api_key=None,
+                 image_noise_bits=5, seed=None, url_expiry=3600, quota=None, error_download=0.0):
+        self.api_latency = parse_latency(api_latency) if isinstance(api_latency, str) else api_latency
+        self.cdn_latency = parse_latency(cdn_latency) if isinstance(cdn_latency, str) else cdn_latency
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.error_policy = error_policy
+        self.policy_words = [word.lower() for word in policy_words]
+        self.requests_per_minute = requests_per_minute
+        self.api_key = api_key
+        self.image_noise_bits = image_noise_bits
+        self.seed = seed
+        self.url_expiry = url_expiry
+        self.quota = quota
+        self.error_download = error_download
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, StandInHandler)
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.rng_lock = threading.Lock()
+        self.rate_limiter = RateLimiter(config.requests_per_minute) if config.requests_per_minute else None
+        self.images = {}
+        self.images_lock = threading.Lock()
+        self.counts = {"generations": 0, "downloads": 0, "errors": 0}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def random(self):
+        with self.rng_lock:
+            return self.rng.random()
+
+    def sample(self, distribution):
+        with self.rng_lock:
+            return distribution(self.rng)
+
+    def image(self, width, height, variant):
+        key = (width, height, variant % IMAGE_VARIANTS)
+        with self.images_lock:
+            if key not in self.images:
+                self.images[key] = make_png(width, height, key[2], self.config.image_noise_bits, random.Random(key[2]))
+            return self.images[key]
+
+    def count(self, name):
+        with self.rng_lock:
+            self.counts[name] += 1
+            return self.counts[name] - 1
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'dalleforanki-standin/1.0'
+    # Headers and body go out in separate writes; with Nagle on, keep-alive clients wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-request-id', f"req_{uuid.uuid4().hex}")
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message, error_type, code=None, headers=None):
+        self.server.count("errors")
+        self.send_json(status, {"error": {"message": message, "type": error_type, "param": None, "code": code}}, headers)
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if path.rstrip('/') not in ('/v1/images/generations', '/images/generations'):
+            self.send_error_json(404, f"Unknown endpoint {path}", 'invalid_request_error')
+            return
+
+        config = self.server.config
+        if config.api_key is not None and self.headers.get('Authorization') != f"Bearer {config.api_key}":
+            self.send_error_json(401, "Incorrect API key provided.", 'invalid_request_error', 'invalid_api_key')
+            return
+
+        if config.quota is not None and self.server.counts["generations"] >= config.quota:
+            self.send_error_json(429, "You exceeded your current quota, please check your plan and billing details.",
+                                 'insufficient_quota', 'insufficient_quota')
+            return
+
+        rate_headers = {}
+        if self.server.rate_limiter is not None:
+            allowed, remaining, reset = self.server.rate_limiter.acquire()
+            rate_headers = {
+                'x-ratelimit-limit-requests': config.requests_per_minute,
+                'x-ratelimit-remaining-requests': remaining,
+                'x-ratelimit-reset-requests': f"{reset:.3f}s"
+            }
+            if not allowed:
+                self.send_error_json(429, "Rate limit reached for requests.", 'requests', 'rate_limit_exceeded',
+                                     dict(rate_headers, **{'retry-after': max(1, math.ceil(reset))}))
+                return
+
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError:
+            self.send_error_json(400, "We could not parse the JSON body of your request.", 'invalid_request_error')
+            return
+
+        time.sleep(self.server.sample(config.api_latency))
+
+        prompt = str(request.get('prompt', ''))
+        roll = self.server.random()
+        if roll < config.error_429:
+            self.send_error_json(429, "Rate limit reached for requests.", 'requests', 'rate_limit_exceeded',
+                                 dict(rate_headers, **{'retry-after': 1}))
+            return
+        roll -= config.error_429
+        if roll < config.error_5xx:
+            self.send_error_json(500, "The server had an error while processing your request.", 'server_error', headers=rate_headers)
+            return
+        roll -= config.error_5xx
+        if roll < config.error_policy or any(word in prompt.lower() for word in config.policy_words):
+            self.send_error_json(400, "Your request was rejected as a result of our safety system.",
+                                 'invalid_request_error', 'content_policy_violation', rate_headers)
+            return
+
+        width, height = (int(value) for value in str(request.get('size', '1024x1024')).split('x'))
+        count = int(request.get('n', 1))
+        data = []
+        for _ in range(count):
+            variant = self.server.count("generations")
+            item = {"revised_prompt": prompt}
+            if request.get('response_format') == 'b64_json':
+                item["b64_json"] = base64.b64encode(self.server.image(width, height, variant)).decode('ascii')
+            else:
+                host = self.headers.get('Host') or '%s:%s' % self.server.server_address[:2]
+                expires = int(time.time()) + config.url_expiry
+                item["url"] = f"http://{host}/images/{width}x{height}-{variant}.png?se={expires}"
+            data.append(item)
+        self.send_json(200, {"created": int(time.time()), "data": data}, rate_headers)
+
+    def do_GET(self):
+        if urlsplit(self.path).path.rstrip('/') in ('/v1/models', '/models'):
+            self.send_models()
+        else:
+            self.send_image(include_body=True)
+
+    def do_HEAD(self):
+        self.send_image(include_body=False)
+
+    def send_models(self):
+        # What the addon calls to check an API key
+        config = self.server.config
+        if config.api_key is not None and self.headers.get('Authorization') != f"Bearer {config.api_key}":
+            self.send_error_json(401, "Incorrect API key provided.", 'invalid_request_error', 'invalid_api_key')
+            return
+        self.send_json(200, {"object": "list", "data": [{"id": IMAGE_MODEL_ID, "object": "model", "owned_by": "system"}]})
+
+    def send_image(self, include_body):
+        url = urlsplit(self.path)
+        name = url.path.rsplit('/', 1)[-1]
+        try:
+            size, variant = name[:-len('.png')].split('-')
+            width, height = (int(value) for value in size.split('x'))
+            variant = int(variant)
+        except ValueError:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        query = dict(part.split('=', 1) for part in url.query.split('&') if '=' in part)
+        if 'se' in query and int(query['se']) < time.time():
+            self.send_response(403)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if include_body:
+            time.sleep(self.server.sample(self.server.config.cdn_latency))
+            self.server.count("downloads")
+        image = self.server.image(width, height, variant)
+
+        # Minimal single-range support, enough for resumed downloads
+        start, end = 0, len(image) - 1
+        etag = f'"{width}x{height}-{variant % IMAGE_VARIANTS}"'
+        range_header = self.headers.get('Range')
+        if self.headers.get('If-Range', etag) != etag:
+            range_header = None  # The client's partial copy is of another file
+        if range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[len('bytes='):].partition('-')
+            start = int(first) if first else 0
+            end = min(int(last), end) if last else end
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(image)}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if include_body and self.server.random() < self.server.config.error_download:
+            # Drop the connection halfway through the body, like a reset or a timeout on a slow CDN
+            self.server.count("errors")
+            self.wfile.write(image[start:start + (end - start + 1) // 2])
+            self.close_connection = True
+        elif include_body:
+            self.wfile.write(image[start:end + 1])
+
+def start_server(config=None, host='127.0.0.1', port=0):
+    """Start a stand-in server on a background thread and return it; port 0 picks a free port."""
+    server = StandInServer((host, port), config or StandInConfig())
+    thread = threading.Thread(target=server.serve_forever, name='dalleforanki-standin', daemon=True)
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--api-latency', default='fixed:0', type=parse_latency,
+                        help='Latency of the generation call, e.g. fixed:8, uniform:5,15, lognormal:10,0.3')
+    parser.add_argument('--cdn-latency', default='fixed:0', type=parse_latency, help='Latency before serving an image')
+    parser.add_argument('--error-429', type=float, default=0.0, help='Fraction of generations answered with 429')
+    parser.add_argument('--error-5xx', type=float, default=0.0, help='Fraction of generations answered with 500')
+    parser.add_argument('--error-policy', type=float, default=0.0, help='Fraction of generations rejected by the content policy')
+    parser.add_argument('--policy-word', action='append', default=[], help='Always reject prompts containing this word')
+    parser.add_argument('--rpm', type=int, default=0, help='Requests per minute before answering 429 (0 = unlimited)')
+    parser.add_argument('--quota', type=int, default=None, help='Answer insufficient_quota after this many images')
+    parser.add_argument('--api-key', default=None, help='Only accept this key (default: accept any key)')
+    parser.add_argument('--image-noise-bits', type=int, default=5, help='Random low bits per channel, 0 gives tiny, very compressible images')
+    parser.add_argument('--url-expiry', type=int, default=3600, help='Seconds until image URLs expire')
+    parser.add_argument('--error-download', type=float, default=0.0, help='Fraction of image downloads cut off halfway')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    config = StandInConfig(args.api_latency, args.cdn_latency, args.error_429, args.error_5xx, args.error_policy,
+                           args.policy_word, args.rpm, args.api_key, args.image_noise_bits, args.seed, args.url_expiry,
+                           args.quota, args.error_download)
+    server = StandInServer((args.host, args.port), config)
+    print(f"Serving stand-in OpenAI images API, set the addon's Base URL to {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
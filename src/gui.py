@@ -0,0 +1,656 @@
+import os
+import json
+from aqt.qt import Qt, QPushButton, QLabel, QLineEdit, QComboBox, QVBoxLayout, QHBoxLayout, QTextEdit, QDialog, QProgressBar, QThread, QTimer, QTableWidget, QTableWidgetItem, QAbstractItemView, pyqtSignal
+from aqt.utils import tooltip, showText
+
+from . import run_log, activity, retries
+from .core import (RESIZE_OPTIONS, NOTE_ORDER_OPTIONS, RESUME_STATE_FILE, RUN_STATS_FILE, FailedNoteQueue, RejectedPromptCache,
+                   FallbackNoteStore, DownloadOrigins, CollectionAdapter, GenerationRun, create_image_client, configure_run)
+from .addon_state import read_state, write_state, state_path, CONFIG_FILE
+
+class GenerateImagesThread(QThread):
+    finished = pyqtSignal(int, int, int)  # Successes, errors, skipped rejected prompts
+    tripped = pyqtSignal(str, int)  # Circuit breaker message, number of notes left for resume
+    cancel = pyqtSignal()  # Signal to notify cancellation
+
+    def __init__(self, app, nids, settings=None, note_settings=None):
+        QThread.__init__(self)
+        self.app = app
+        # The pipeline itself lives in core.py, this thread only runs it off the GUI thread
+        self.engine = GenerationRun(CollectionAdapter(app.browser.mw.col), app.image_client, nids,
+                                    settings if settings is not None else app.current_settings, note_settings,
+                                    on_tripped=self.tripped.emit, before_write=self.wait_for_sync)
+        # Polled by the progress dialog at a fixed rate instead of emitting a signal per note
+        self.run_progress = self.engine.run_progress
+
+    def run(self):
+        self.finished.emit(*self.engine.run())
+
+    def cancel(self):
+        self.engine.cancel()
+
+    def wait_for_sync(self):
+        return activity.monitor.wait_for_writes(self.engine.settings, lambda: self.engine.cancelled)
+
+class WarmUpThread(QThread):
+    key_rejected = pyqtSignal(str)  # Error message from the API
+
+    def __init__(self, image_client, validate_key):
+        QThread.__init__(self)
+        self.image_client = image_client
+        self.validate_key = validate_key
+
+    def run(self):
+        rejection = self.image_client.warm_up(DownloadOrigins.shared().origins, self.validate_key)
+        if rejection:
+            self.key_rejected.emit(rejection)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+class ProgressBarDialog(QDialog):
+    REFRESH_INTERVAL_MS = 250
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Processing")
+        self.setModal(True)
+        self.setFixedSize(360, 260)
+        layout = QVBoxLayout()
+        self.progress_bar = QProgressBar()
+        layout.addWidget(self.progress_bar)
+
+        self.stats_label = QLabel("")
+        self.stats_label.setWordWrap(True)
+        layout.addWidget(self.stats_label)
+
+        self.status_label = QLabel("")
+        layout.addWidget(self.status_label)
+
+        # Updates are coalesced to a fixed refresh rate however fast notes complete
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel)
+        layout.addWidget(self.cancel_button)
+
+        self.setLayout(layout)
+
+    def set_thread(self, thread):
+        self.thread = thread
+        self.refresh()
+        self.refresh_timer.start(self.REFRESH_INTERVAL_MS)
+
+    def refresh(self):
+        snapshot = self.thread.run_progress.snapshot()
+        self.progress_bar.setValue(snapshot["percent"])
+
+        lines = [
+            f"{snapshot['processed']} / {snapshot['total']} notes, {snapshot['in_flight']} in flight",
+            f"{snapshot['images_per_minute']:.1f} images/min, elapsed {format_duration(snapshot['elapsed'])}, "
+            f"ETA {format_duration(snapshot['eta'])}"
+        ]
+        if snapshot["rate_limit_remaining"] is not None:
+            limit = f" / {snapshot['rate_limit_limit']}" if snapshot["rate_limit_limit"] is not None else ""
+            lines.append(f"Rate limit headroom: {snapshot['rate_limit_remaining']}{limit} requests")
+        if activity.monitor.mode(self.thread.engine.settings) == activity.MODE_PAUSED:
+            lines.append("Paused: images are saved once AnkiWeb sync has finished")
+        if snapshot["errors_by_class"]:
+            lines.append("Errors: " + ", ".join(f"{error_class} {count}" for error_class, count
+                                                in sorted(snapshot["errors_by_class"].items())))
+        self.stats_label.setText("\n".join(lines))
+
+    def cancel(self):
+        if self.thread.isRunning():
+            self.status_label.setText("Cancelling operation, please wait...")
+            self.thread.cancel()
+
+    def closeEvent(self, event):
+        self.refresh_timer.stop()
+        if self.thread.isRunning():
+            self.thread.cancel()
+        super().closeEvent(event)
+
+class RejectedPromptsDialog(QDialog):
+    def __init__(self, app):
+        super().__init__(app)
+        self.app = app
+        self.setWindowTitle('Rejected Prompts')
+        self.setMinimumSize(700, 400)
+        layout = QVBoxLayout()
+
+        self.info_label = QLabel('These prompts were rejected by the content filter and are skipped on future runs. '
+                                 'Edit the notes so they render a different prompt, or force a retry of the selected prompts.')
+        self.info_label.setWordWrap(True)
+        layout.addWidget(self.info_label)
+
+        self.table = QTableWidget()
+        self.table.setColumnCount(3)
+        self.table.setHorizontalHeaderLabels(['Note ID', 'Rejected', 'Prompt'])
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        layout.addWidget(self.table)
+
+        button_layout = QHBoxLayout()
+        self.edit_button = QPushButton('Edit Notes')
+        self.edit_button.clicked.connect(self.edit_selected)
+        self.retry_button = QPushButton('Force Retry')
+        self.retry_button.clicked.connect(self.retry_selected)
+        self.forget_button = QPushButton('Forget')
+        self.forget_button.clicked.connect(self.forget_selected)
+        button_layout.addWidget(self.edit_button)
+        button_layout.addWidget(self.retry_button)
+        button_layout.addWidget(self.forget_button)
+        layout.addLayout(button_layout)
+
+        self.setLayout(layout)
+        self.populate_table()
+
+    def populate_table(self):
+        self.rejected_prompts = RejectedPromptCache.shared()
+        self.fallback_notes = FallbackNoteStore.shared()
+        with self.rejected_prompts.lock:
+            self.keys = list(self.rejected_prompts.entries)
+        self.table.setRowCount(len(self.keys))
+        for row, key in enumerate(self.keys):
+            entry = self.rejected_prompts.entries[key]
+            self.table.setItem(row, 0, QTableWidgetItem(str(entry["Note ID"])))
+            self.table.setItem(row, 1, QTableWidgetItem(entry["Rejected"]))
+            self.table.setItem(row, 2, QTableWidgetItem(entry["Prompt"]))
+
+    def selected_keys(self):
+        rows = sorted({index.row() for index in self.table.selectionModel().selectedRows()})
+        return [self.keys[row] for row in rows]
+
+    def edit_selected(self):
+        nids = [self.rejected_prompts.entries[key]["Note ID"] for key in self.selected_keys()]
+        if not nids:
+            tooltip('No prompts selected.')
+            return
+        self.app.browser.search_for("nid:" + ",".join(str(nid) for nid in nids))
+        self.close()
+
+    def retry_selected(self):
+        keys = self.selected_keys()
+        if not keys:
+            tooltip('No prompts selected.')
+            return
+        nids = [self.rejected_prompts.entries[key]["Note ID"] for key in keys]
+        self.forget_selected()
+        self.close()
+        self.app.fetch_dialog_settings()
+        self.app.start_run(nids, self.app.current_settings)
+
+    def forget_selected(self):
+        for key in self.selected_keys():
+            self.rejected_prompts.forget(key)
+        self.rejected_prompts.save()
+        self.populate_table()
+        self.app.update_rejected_prompts_button()
+
+class AIApp(QDialog):
+    current_settings = {
+        "Note Fields": [],
+        "Sentence Field": "",
+        "Term Field": "",
+        "Image Field": "",
+        "Resize Height": "",
+        "Conflict Action": "",
+        "Note Order": 0,
+        "Generate While Reviewing": False,
+        "Review Prefetch Count": 3,
+        "Generate For New Notes": False,
+        "New Note Types": [],
+        "New Note Batch Size": 5,
+        "New Note Batch Delay Seconds": 5,
+        "New Note Images Per Minute": 10,
+        "Pause During Sync": True,
+        "Idle After Seconds": 60,
+        "Throttled Delay Seconds": 20,
+        "API Key": "",
+        "Default Prompt": "",
+        "Current Prompt": "",
+        "Base URL": "", # Add Base URL to current settings
+        "Generation Client": "sdk",
+        "Warm Up Connections": True,
+        "Validate API Key": False,
+        "Circuit Breaker Threshold": 3,
+        "Auto Retry Failed": False,
+        "Skip Rejected Prompts": True,
+        "Retry With Fallback Prompt": False,
+        "Fallback Prompt": "A simple, friendly illustration of {term}. The image has no text.",
+        "Debug Logging": False,
+        "Log Max Bytes": 5242880,
+        "Log Backup Count": 3,
+        "Profile Modes": [],
+        "Profile Tracemalloc Every N Notes": 50,
+        "Profile Sample Interval Ms": 10,
+        "Trace Connections": False,
+        "Export Metrics": False,
+        "Metrics Export Dir": "",
+        "Metrics Export Interval Seconds": 15
+    }
+
+    def __init__(self, browser):
+        super().__init__()
+        self.browser = browser
+        self.thread = None
+        self.image_client = None
+        self.warm_up_thread = None
+        self.claimed_nids = []
+        self.init_ui()
+
+    def init_ui(self):
+        self.setWindowTitle('DALL-E for Anki')
+        self.setMinimumSize(500, 600)
+        self.read_config()
+
+        # Set main and sublayout styles
+        self.main_layout = QVBoxLayout()
+        self.dropdown_field_layout = QVBoxLayout()
+        self.line_edit_layout = QVBoxLayout()
+        self.button_layout = QHBoxLayout()
+
+        self.sentence_dropdown_label = QLabel('Sentence Field')
+        self.sentence_dropdown = QComboBox()
+
+        self.term_dropdown_label = QLabel('Target Word Field')
+        self.term_dropdown = QComboBox()
+
+        self.write_image_label = QLabel('Image Field')
+        self.write_image_field = QComboBox()
+
+        self.resize_image_label = QLabel('Resize Images to Max Height:')
+        self.resize_image_combo = QComboBox()
+        self.resize_image_combo.addItems(RESIZE_OPTIONS)
+        resize_index = self.fetch_resize_index()
+        self.resize_image_combo.setCurrentIndex(resize_index)
+
+        self.resize_image_advisement = QLabel('It is also possible to resize images by using custom CSS on your cards.  Reference readme for more info.')
+        self.resize_image_advisement.setWordWrap(True)
+
+        self.conflict_action_label = QLabel('If Image Field is not Empty:')
+        self.conflict_action_combo = QComboBox()
+        conflict_actions = ['Overwrite', 'Add', 'Skip']
+        self.conflict_action_combo.addItems(conflict_actions)
+        conflict_index = self.fetch_conflict_index()
+        self.conflict_action_combo.setCurrentIndex(conflict_index)
+
+        self.note_order_label = QLabel('Process Notes In Order Of:')
+        self.note_order_combo = QComboBox()
+        self.note_order_combo.addItems(NOTE_ORDER_OPTIONS)
+        self.note_order_combo.setCurrentIndex(AIApp.current_settings.get("Note Order", 0))
+
+        self.dropdown_field_layout.addWidget(self.sentence_dropdown_label)
+        self.dropdown_field_layout.addWidget(self.sentence_dropdown)
+        self.dropdown_field_layout.addWidget(self.term_dropdown_label)
+        self.dropdown_field_layout.addWidget(self.term_dropdown)
+        self.dropdown_field_layout.addWidget(self.write_image_label)
+        self.dropdown_field_layout.addWidget(self.write_image_field)
+        self.dropdown_field_layout.addWidget(self.resize_image_label)
+        self.dropdown_field_layout.addWidget(self.resize_image_combo)
+        self.dropdown_field_layout.addWidget(self.resize_image_advisement)
+        self.dropdown_field_layout.addWidget(self.conflict_action_label)
+        self.dropdown_field_layout.addWidget(self.conflict_action_combo)
+        self.dropdown_field_layout.addWidget(self.note_order_label)
+        self.dropdown_field_layout.addWidget(self.note_order_combo)
+
+        self.api_key_label = QLabel('OpenAI API Key')
+        self.api_key_field = QLineEdit()
+        self.api_key_field.setPlaceholderText('Enter your secret API key with no quotes')
+        api_key = self.fetch_api_key()
+        self.api_key_field.setText(api_key)
+
+        # Add Base URL UI element
+        self.base_url_label = QLabel('Base URL (Optional)')
+        self.base_url_field = QLineEdit()
+        self.base_url_field.setPlaceholderText('Enter custom Base URL (optional)')
+        base_url = self.fetch_base_url()
+        self.base_url_field.setText(base_url)
+
+        self.prompt_label = QLabel('DALL-E Prompt')
+        self.prompt_field = QTextEdit()
+        self.prompt_field.setFixedHeight(100)  # Adjusted height
+        prompt = self.set_display_prompt()
+        self.prompt_field.setText(prompt)
+        self.prompt_field.textChanged.connect(self.update_current_prompt)
+        self.prompt_field_key = QLabel('Note: longer prompts will consume more tokens and may increase cost of API request. DALL-E-3 automatically rewrites user prompts to improve results and so very verbose prompts/excessive prompt engineering is usually not necessary.')
+        self.prompt_field_key.setWordWrap(True)
+
+        self.line_edit_layout.addWidget(self.api_key_label)
+        self.line_edit_layout.addWidget(self.api_key_field)
+        # Add Base URL to layout
+        self.line_edit_layout.addWidget(self.base_url_label)
+        self.line_edit_layout.addWidget(self.base_url_field)
+        self.line_edit_layout.addWidget(self.prompt_label)
+        self.line_edit_layout.addWidget(self.prompt_field)
+        self.line_edit_layout.addWidget(self.prompt_field_key)
+
+        self.exit_button = QPushButton('Save and Exit')
+        self.exit_button.clicked.connect(self.exit_and_save)
+        self.default_button = QPushButton('Default Prompt')
+        self.default_button.clicked.connect(self.reset_prompt)
+        self.generate_button = QPushButton('Generate')
+        self.generate_button.clicked.connect(self.process_notes)
+        self.resume_button = QPushButton('Resume Interrupted Run')
+        self.resume_button.clicked.connect(self.resume_interrupted_run)
+        self.button_layout.addWidget(self.exit_button)
+        self.button_layout.addWidget(self.default_button)
+        self.button_layout.addWidget(self.generate_button)
+        self.retry_failed_button = QPushButton('Retry Failed')
+        self.retry_failed_button.clicked.connect(self.retry_failed_notes)
+        self.button_layout.addWidget(self.resume_button)
+        self.button_layout.addWidget(self.retry_failed_button)
+        self.rejected_prompts_button = QPushButton('Rejected Prompts')
+        self.rejected_prompts_button.clicked.connect(self.show_rejected_prompts)
+        self.button_layout.addWidget(self.rejected_prompts_button)
+        self.update_resume_button()
+        self.update_retry_failed_button()
+        self.update_rejected_prompts_button()
+
+        self.main_layout.addLayout(self.dropdown_field_layout)
+        self.main_layout.addLayout(self.line_edit_layout)
+        self.main_layout.addLayout(self.button_layout)
+        self.main_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
+        self.setLayout(self.main_layout)
+
+        self.populate_dropdowns()  # Populate dropdowns after they are created
+
+    def showEvent(self, event):
+        self.update_fields_dict()
+        self.update_resume_button()
+        self.update_retry_failed_button()
+        self.update_rejected_prompts_button()
+        super().showEvent(event)
+
+    def closeEvent(self, event):
+        self.exit_and_save()
+        super().closeEvent(event)
+
+    def read_config(self):
+        try:
+            with open(state_path(CONFIG_FILE), 'r') as config:
+                config_data = json.load(config)
+                AIApp.current_settings.update(config_data)
+        except FileNotFoundError:
+            print('No config JSON was located.')
+        except PermissionError:
+            print('Permission Error.')
+
+    def set_display_prompt(self):
+        if AIApp.current_settings["Current Prompt"] == "":
+            prompt = AIApp.current_settings["Default Prompt"]
+        else:
+            prompt = AIApp.current_settings["Current Prompt"]
+        return prompt
+
+    def reset_prompt(self):
+        self.prompt_field.setText(AIApp.current_settings["Default Prompt"])
+
+    def fetch_api_key(self):
+        if AIApp.current_settings["API Key"] != "":
+            return AIApp.current_settings["API Key"]
+        else:
+            return ""
+    
+    # Fetch Base URL from config
+    def fetch_base_url(self):
+        return AIApp.current_settings.get("Base URL", "")
+
+    def fetch_conflict_index(self):
+        if AIApp.current_settings["Conflict Action"] != "":
+            return AIApp.current_settings["Conflict Action"]
+        else:
+            return 0
+
+    def fetch_resize_index(self):
+        if AIApp.current_settings["Resize Height"] != "":
+            return AIApp.current_settings["Resize Height"]
+        else:
+            return 1
+
+    def exit_and_save(self):
+        AIApp.current_settings["Current Prompt"] = self.prompt_field.toPlainText()
+        AIApp.current_settings["API Key"] = self.api_key_field.text()
+        AIApp.current_settings["Term Field"] = self.term_dropdown.currentText()
+        AIApp.current_settings["Sentence Field"] = self.sentence_dropdown.currentText()
+        AIApp.current_settings["Image Field"] = self.write_image_field.currentText()
+        AIApp.current_settings["Conflict Action"] = self.conflict_action_combo.currentIndex()
+        AIApp.current_settings["Resize Height"] = self.resize_image_combo.currentIndex()
+        AIApp.current_settings["Note Order"] = self.note_order_combo.currentIndex()
+        # Save Base URL
+        AIApp.current_settings["Base URL"] = self.base_url_field.text()
+
+        # The background workers read it at any time, see addon_state.load_settings
+        write_state(state_path(CONFIG_FILE), AIApp.current_settings)
+        self.close()
+
+    def get_selected_note_ids(self):
+        nids = self.browser.selectedNotes()
+        if not nids:
+            tooltip('No cards selected.')
+            return []
+        return nids
+
+    def get_note_fields(self):
+        nids = self.get_selected_note_ids()
+        if not nids:
+            return []
+        sample_nid = nids[0]
+        mw = self.browser.mw
+        # Replace getNote with get_note
+        note = mw.col.get_note(sample_nid)
+        # Replace model with note_type
+        model = note.note_type()
+        # Replace fieldNames with field_names
+        fields = mw.col.models.field_names(model)
+        return fields
+
+    def populate_dropdowns(self):
+        fields = AIApp.current_settings["Note Fields"]
+        self.sentence_dropdown.addItems(fields)
+        self.term_dropdown.addItems(fields)
+        self.write_image_field.addItems(fields)
+
+    def update_fields_dict(self):
+        new_fields = set(self.get_note_fields())
+
+        # Only update settings if the new fields are different
+        if set(AIApp.current_settings["Note Fields"]) != new_fields:
+            AIApp.current_settings["Note Fields"] = list(new_fields)
+
+        # Save current selections
+        current_sentence = self.sentence_dropdown.currentText()
+        current_term = self.term_dropdown.currentText()
+        current_image = self.write_image_field.currentText()
+
+        # Clear and update dropdown items
+        self.sentence_dropdown.clear()
+        self.term_dropdown.clear()
+        self.write_image_field.clear()
+
+        self.populate_dropdowns()
+
+        # Restore previous selections if they still exist
+        if current_sentence in AIApp.current_settings["Note Fields"]:
+            self.sentence_dropdown.setCurrentText(current_sentence)
+        if current_term in AIApp.current_settings["Note Fields"]:
+            self.term_dropdown.setCurrentText(current_term)
+        if current_image in AIApp.current_settings["Note Fields"]:
+            self.write_image_field.setCurrentText(current_image)
+
+        # Ensure the dropdowns reflect the stored settings if nothing was selected
+        if isinstance(AIApp.current_settings["Sentence Field"], str) and AIApp.current_settings["Sentence Field"] in AIApp.current_settings["Note Fields"]:
+            self.sentence_dropdown.setCurrentText(AIApp.current_settings["Sentence Field"])
+        if isinstance(AIApp.current_settings["Term Field"], str) and AIApp.current_settings["Term Field"] in AIApp.current_settings["Note Fields"]:
+            self.term_dropdown.setCurrentText(AIApp.current_settings["Term Field"])
+        if isinstance(AIApp.current_settings["Image Field"], str) and AIApp.current_settings["Image Field"] in AIApp.current_settings["Note Fields"]:
+            self.write_image_field.setCurrentText(AIApp.current_settings["Image Field"])
+
+    def update_current_prompt(self):
+        AIApp.current_settings["Current Prompt"] = self.prompt_field.toPlainText()
+
+    def fetch_dialog_settings(self):
+        # Fetch current settings from the dialog
+        self.current_settings["API Key"] = self.api_key_field.text()
+        self.current_settings["Term Field"] = self.term_dropdown.currentText()
+        self.current_settings["Sentence Field"] = self.sentence_dropdown.currentText()
+        self.current_settings["Image Field"] = self.write_image_field.currentText()
+        self.current_settings["Conflict Action"] = self.conflict_action_combo.currentIndex()
+        self.current_settings["Resize Height"] = self.resize_image_combo.currentIndex()
+        self.current_settings["Note Order"] = self.note_order_combo.currentIndex()
+        # Fetch Base URL
+        self.current_settings["Base URL"] = self.base_url_field.text()
+
+    def process_notes(self):
+        self.fetch_dialog_settings()
+
+        nids = self.get_selected_note_ids()
+        if not nids:
+            return
+
+        self.start_run(nids, self.current_settings)
+
+    def update_resume_button(self):
+        resume_state = read_state(state_path(RESUME_STATE_FILE), None)
+        if resume_state and resume_state.get("Note IDs"):
+            self.resume_button.setText(f'Resume Interrupted Run ({len(resume_state["Note IDs"])})')
+            self.resume_button.setVisible(True)
+        else:
+            self.resume_button.setVisible(False)
+
+    def resume_interrupted_run(self):
+        resume_state = read_state(state_path(RESUME_STATE_FILE), None)
+        if not resume_state or not resume_state.get("Note IDs"):
+            tooltip('No interrupted run to resume.')
+            self.update_resume_button()
+            return
+
+        # Account settings come from the dialog (the key may have been fixed), job settings from the interrupted run
+        self.fetch_dialog_settings()
+        settings = dict(self.current_settings)
+        settings.update(resume_state.get("Settings", {}))
+
+        note_settings = {int(nid): job for nid, job in resume_state.get("Note Settings", {}).items()}
+
+        os.remove(state_path(RESUME_STATE_FILE))
+        self.update_resume_button()
+        self.start_run(resume_state["Note IDs"], settings, note_settings)
+
+    def update_retry_failed_button(self):
+        failed_count = len(FailedNoteQueue.shared())
+        self.retry_failed_button.setText(f'Retry Failed ({failed_count})')
+        self.retry_failed_button.setVisible(failed_count > 0)
+
+    def retry_failed_notes(self):
+        self.fetch_dialog_settings()
+        failed_queue = FailedNoteQueue.shared()
+        if not failed_queue.nids():
+            tooltip('No failed notes to retry.')
+            self.update_retry_failed_button()
+            return
+        # Notes the automatic retries are working on are left to them, released in on_processing_finished
+        nids = failed_queue.claim(failed_queue.nids())
+        if not nids:
+            tooltip('The failed notes are being retried in the background.')
+            return
+        self.claimed_nids = nids
+        self.start_run(nids, self.current_settings, failed_queue.settings_by_nid(nids))
+
+    def update_rejected_prompts_button(self):
+        rejected_count = len(RejectedPromptCache.shared())
+        self.rejected_prompts_button.setText(f'Rejected Prompts ({rejected_count})')
+        self.rejected_prompts_button.setVisible(rejected_count > 0)
+
+    def show_rejected_prompts(self):
+        RejectedPromptsDialog(self).exec()
+
+    def start_run(self, nids, settings, note_settings=None):
+        self.prepare_run(settings)
+        self.circuit_breaker_message = None
+        run_log.log_event(f"Starting run of {len(nids)} notes", stage="run")
+
+        self.progress_dialog = ProgressBarDialog(self)
+        self.thread = GenerateImagesThread(self, nids, settings, note_settings)
+        self.progress_dialog.set_thread(self.thread)
+        
+        self.progress_dialog.show()
+
+        # Start the background thread for processing notes
+        self.thread.tripped.connect(self.on_circuit_breaker_tripped)
+        self.thread.finished.connect(self.on_processing_finished)
+        self.thread.start()
+
+    def prepare_run(self, settings):
+        configure_run(settings)
+        self.update_image_client(settings)
+        if self.image_client.connection_tracer is not None:
+            self.image_client.connection_tracer.reset()
+
+    def update_image_client(self, settings):
+        # The client and its open connections are kept until the API key, Base URL or client type change
+        if self.image_client is not None and self.image_client.matches(settings):
+            return
+        if self.image_client is not None:
+            self.image_client.close()
+        self.image_client = create_image_client(settings)
+
+    def start_warm_up(self):
+        # Connect to the API while the user is still setting up the run, so the first note doesn't pay for it
+        if not self.current_settings.get("Warm Up Connections") or not self.api_key_field.text():
+            return
+        if self.warm_up_thread is not None and self.warm_up_thread.isRunning():
+            return
+        settings = dict(self.current_settings, **{"API Key": self.api_key_field.text(), "Base URL": self.base_url_field.text()})
+        self.update_image_client(settings)
+        self.warm_up_thread = WarmUpThread(self.image_client, self.current_settings.get("Validate API Key", False))
+        self.warm_up_thread.key_rejected.connect(self.on_api_key_rejected)
+        self.warm_up_thread.start()
+
+    def on_api_key_rejected(self, message):
+        tooltip(f'The API key was rejected: {message}', parent=self, period=8000)
+
+    def on_circuit_breaker_tripped(self, reason, remaining_count):
+        self.circuit_breaker_message = (f"Stopped early because of an account error: {reason}\n\n"
+                                        f"{remaining_count} notes were saved and can be processed later with 'Resume Interrupted Run'.")
+        self.update_resume_button()
+
+    def on_processing_finished(self, success_count, error_count, skipped_count):
+        FailedNoteQueue.shared().release(self.claimed_nids)
+        self.claimed_nids = []
+        self.progress_dialog.close()
+        message = f"Processing finished: {success_count} successes, {error_count} errors."
+        if skipped_count:
+            message += f"\n\n{skipped_count} notes were skipped because their prompt was rejected by the content filter before. See 'Rejected Prompts'."
+        if self.circuit_breaker_message:
+            message += "\n\n" + self.circuit_breaker_message
+        elif error_count:
+            message += "\n\nFailed notes can be processed again with 'Retry Failed'."
+        message += "\n\nTimings per note:\n" + "\n".join(self.thread.engine.stats.summary_lines())
+        message += f"\n\nThese timings are also saved to {RUN_STATS_FILE} in the addon folder."
+        DownloadOrigins.shared().record(self.image_client.download_origins)
+        if self.image_client.connection_tracer is not None:
+            message += "\n\nConnections:\n" + "\n".join(self.image_client.connection_tracer.summary_lines())
+        if self.thread.engine.profiler.files:
+            message += "\n\nProfiling output:\n" + "\n".join(self.thread.engine.profiler.files)
+        self.update_retry_failed_button()
+        self.update_rejected_prompts_button()
+        retries.on_run_finished(self.browser.mw)
+        showText(message, parent=self, title='Processing finished', copyBtn=True)
+
+app_instance = None
+
+def show_ai_app(browser):
+    global app_instance
+    if app_instance is None:
+        app_instance = AIApp(browser)
+    app_instance.update_fields_dict()
+    app_instance.start_warm_up()
+    app_instance.exec()
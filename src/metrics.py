@@ -0,0 +1,327 @@
+import os
+import json
+import math
+import time
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Pipeline stages in the order they run for a note
+STAGES = ("prompt", "api", "download", "image", "write", "update", "total")
+
+class StageTimer:
+    def __init__(self):
+        self.durations = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0.0) + time.perf_counter() - start
+
+class LatencyHistogram:
+    def __init__(self):
+        self.samples = []
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, percent):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        # Nearest-rank percentile, good enough for a few thousand samples per run
+        rank = max(1, math.ceil(percent / 100 * len(ordered)))
+        return ordered[rank - 1]
+
+    def summary(self):
+        if not self.samples:
+            return {"count": 0}
+        ordered = sorted(self.samples)
+        return {
+            "count": len(ordered),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": ordered[-1],
+            "sum": sum(ordered)
+        }
+
+class RunStats:
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+        self.errors_by_class = {}
+        self.connections = None
+
+    def record_note(self, timer):
+        for stage, seconds in timer.durations.items():
+            self.histograms.setdefault(stage, LatencyHistogram()).add(seconds)
+        METRICS.observe_stages(timer.durations)
+
+    def record_error(self, error_class):
+        self.errors_by_class[error_class] = self.errors_by_class.get(error_class, 0) + 1
+        METRICS.inc("errors_total", labels=(("class", error_class),))
+
+    def finish(self):
+        self.finished = time.time()
+
+    def to_dict(self):
+        return {
+            "started": self.started,
+            "finished": self.finished,
+            "stages": {stage: histogram.summary() for stage, histogram in self.histograms.items()},
+            "errors_by_class": self.errors_by_class,
+            "connections": self.connections
+        }
+
+    def summary_lines(self):
+        lines = [f"{'Stage':<10}{'Count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'Max':>10}"]
+        for stage, histogram in self.histograms.items():
+            summary = histogram.summary()
+            if not summary["count"]:
+                continue
+            lines.append(f"{stage:<10}{summary['count']:>7}" + "".join(
+                f"{summary[key] * 1000:>8.0f}ms" for key in ("p50", "p95", "p99", "max")))
+        if self.errors_by_class:
+            lines.append("")
+            lines.append("Errors by class:")
+            for error_class, count in sorted(self.errors_by_class.items(), key=lambda item: -item[1]):
+                lines.append(f"  {error_class}: {count}")
+        return lines
+
+    def save(self, filename):
+        with open(filename, 'w') as stats_file:
+            json.dump(self.to_dict(), stats_file, indent=4)
+
+class RunProgress:
+    """Live counters shared between the worker and the progress dialog, which polls them."""
+
+    def __init__(self, total):
+        self.lock = threading.Lock()
+        self.total = total
+        self.processed = 0
+        self.succeeded = 0
+        self.in_flight = 0
+        self.errors_by_class = {}
+        self.rate_limit_remaining = None
+        self.rate_limit_limit = None
+        self.started = time.monotonic()
+
+    def note_started(self):
+        with self.lock:
+            self.in_flight += 1
+        METRICS.add_gauge("in_flight", 1)
+
+    def note_finished(self, succeeded=False, error_class=None):
+        with self.lock:
+            self.in_flight -= 1
+            self.processed += 1
+            if succeeded:
+                self.succeeded += 1
+            if error_class is not None:
+                self.errors_by_class[error_class] = self.errors_by_class.get(error_class, 0) + 1
+        METRICS.add_gauge("in_flight", -1)
+        METRICS.inc("notes_processed_total")
+        if succeeded:
+            METRICS.inc("images_generated_total")
+
+    def record_rate_limit(self, headers):
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        limit = headers.get("x-ratelimit-limit-requests")
+        with self.lock:
+            if remaining is not None:
+                self.rate_limit_remaining = int(remaining)
+                METRICS.set_gauge("rate_limit_remaining_requests", self.rate_limit_remaining)
+            if limit is not None:
+                self.rate_limit_limit = int(limit)
+                METRICS.set_gauge("rate_limit_limit_requests", self.rate_limit_limit)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            processed = self.processed
+            snapshot = {
+                "total": self.total,
+                "processed": processed,
+                "succeeded": self.succeeded,
+                "in_flight": self.in_flight,
+                "errors_by_class": dict(self.errors_by_class),
+                "rate_limit_remaining": self.rate_limit_remaining,
+                "rate_limit_limit": self.rate_limit_limit,
+                "elapsed": elapsed
+            }
+        snapshot["percent"] = processed * 100 // self.total if self.total else 100
+        snapshot["images_per_minute"] = self.succeeded * 60 / elapsed if elapsed > 0 else 0.0
+        snapshot["eta"] = (self.total - processed) * elapsed / processed if processed else None
+        return snapshot
+
+METRIC_PREFIX = 'dalleforanki_'
+METRIC_HELP = {
+    "images_generated_total": ("counter", "Images generated and written to a note."),
+    "notes_processed_total": ("counter", "Notes processed, whatever the outcome."),
+    "bytes_written_total": ("counter", "Bytes of image data written to the media folder."),
+    "errors_total": ("counter", "Failed notes by error class."),
+    "download_retries_total": ("counter", "Image downloads retried after a failed attempt."),
+    "download_resumed_bytes_total": ("counter", "Image bytes not downloaded again thanks to a Range request."),
+    "images_reused_total": ("counter", "Images downloaded from an earlier attempt's URL instead of generated again."),
+    "in_flight": ("gauge", "Notes currently being processed."),
+    "rate_limit_remaining_requests": ("gauge", "Requests left in the current rate limit window."),
+    "rate_limit_limit_requests": ("gauge", "Requests allowed per rate limit window."),
+    "stage_seconds": ("summary", "Per-note latency of each pipeline stage."),
+}
+SUMMARY_QUANTILES = (0.5, 0.95, 0.99)
+
+class MetricsRegistry:
+    """Process-wide counters and gauges, cheap to update from the worker and exported periodically."""
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.stage_windows = {}
+        self.stage_totals = {}
+        self.window = window
+
+    def inc(self, name, amount=1, labels=()):
+        with self.lock:
+            self.values[(name, labels)] = self.values.get((name, labels), 0) + amount
+
+    def add_gauge(self, name, amount, labels=()):
+        self.inc(name, amount, labels)
+
+    def set_gauge(self, name, value, labels=()):
+        with self.lock:
+            self.values[(name, labels)] = value
+
+    def observe_stages(self, durations):
+        with self.lock:
+            for stage, seconds in durations.items():
+                # Quantiles come from a sliding window so long sessions don't grow without limit
+                self.stage_windows.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+                count, total = self.stage_totals.get(stage, (0, 0.0))
+                self.stage_totals[stage] = (count + 1, total + seconds)
+
+    def snapshot(self):
+        with self.lock:
+            values = dict(self.values)
+            windows = {stage: sorted(window) for stage, window in self.stage_windows.items()}
+            totals = dict(self.stage_totals)
+        stages = {}
+        for stage, ordered in windows.items():
+            count, total = totals[stage]
+            stages[stage] = {
+                "count": count,
+                "sum": total,
+                "quantiles": {str(q): ordered[max(1, math.ceil(q * len(ordered))) - 1] for q in SUMMARY_QUANTILES}
+            }
+        return values, stages
+
+    def to_prometheus(self):
+        values, stages = self.snapshot()
+        lines = []
+        written_headers = set()
+
+        def header(name):
+            if name not in written_headers:
+                kind, help_text = METRIC_HELP.get(name, ("untyped", name))
+                lines.append(f"# HELP {METRIC_PREFIX}{name} {help_text}")
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+                written_headers.add(name)
+
+        for (name, labels), value in sorted(values.items()):
+            header(name)
+            label_text = ",".join(f'{key}="{label_value}"' for key, label_value in labels)
+            lines.append(f"{METRIC_PREFIX}{name}{{{label_text}}} {value}" if label_text else f"{METRIC_PREFIX}{name} {value}")
+        for stage, summary in sorted(stages.items()):
+            header("stage_seconds")
+            for quantile, value in summary["quantiles"].items():
+                lines.append(f'{METRIC_PREFIX}stage_seconds{{stage="{stage}",quantile="{quantile}"}} {value:.6f}')
+            lines.append(f'{METRIC_PREFIX}stage_seconds_sum{{stage="{stage}"}} {summary["sum"]:.6f}')
+            lines.append(f'{METRIC_PREFIX}stage_seconds_count{{stage="{stage}"}} {summary["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        values, stages = self.snapshot()
+        metrics = {}
+        for (name, labels), value in values.items():
+            if labels:
+                metrics.setdefault(name, {})[",".join(f"{key}={label_value}" for key, label_value in labels)] = value
+            else:
+                metrics[name] = value
+        return {"time": time.time(), "metrics": metrics, "stage_seconds": stages}
+
+METRICS = MetricsRegistry()
+
+_write_locks = {}
+_write_locks_lock = threading.Lock()
+
+def write_atomic(filename, text):
+    # Textfile collectors may read at any moment, so never expose a half-written file. Writers of the same file
+    # (the exporter and write_metrics_now, or two runs saving state) take turns, each with its own temp file.
+    with _write_locks_lock:
+        lock = _write_locks.setdefault(os.path.abspath(filename), threading.Lock())
+    with lock:
+        fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or None,
+                                             prefix=os.path.basename(filename), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as output:
+                output.write(text)
+                output.flush()
+                os.fsync(output.fileno())
+            # mkstemp makes the file private, collectors may run as another user
+            os.chmod(temp_filename, 0o644)
+            os.replace(temp_filename, filename)
+        except BaseException:
+            try:
+                os.remove(temp_filename)
+            except OSError:
+                pass
+            raise
+
+class MetricsExporter(threading.Thread):
+    PROMETHEUS_FILE_NAME = 'metrics.prom'
+    JSON_FILE_NAME = 'metrics.json'
+
+    def __init__(self, output_dir, interval, registry=METRICS):
+        super().__init__(name='dalleforanki-metrics-exporter', daemon=True)
+        self.output_dir = output_dir
+        self.interval = interval
+        self.registry = registry
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            write_atomic(os.path.join(self.output_dir, self.PROMETHEUS_FILE_NAME), self.registry.to_prometheus())
+            write_atomic(os.path.join(self.output_dir, self.JSON_FILE_NAME), json.dumps(self.registry.to_json(), indent=4))
+        except OSError as e:
+            print(f'Could not export metrics: {e}')
+
+    def stop(self):
+        self._stop_event.set()
+
+_exporter = None
+
+def start_exporter(output_dir, interval):
+    global _exporter
+    if _exporter is not None and _exporter.output_dir == output_dir and _exporter.interval == interval:
+        return _exporter
+    if _exporter is not None:
+        _exporter.stop()
+    _exporter = MetricsExporter(output_dir, interval)
+    _exporter.start()
+    return _exporter
+
+def write_metrics_now():
+    if _exporter is not None:
+        _exporter.write()
@@ -0,0 +1,105 @@
+import time
+import threading
+
+from .metrics import LatencyHistogram
+
+# Phases reported per request, each measured between two httpcore trace events.
+# httpcore resolves the host inside connect_tcp, so DNS time is part of "connect".
+PHASES = {
+    "connect": ("connect_tcp.started", "connect_tcp.complete"),
+    "tls": ("start_tls.started", "start_tls.complete"),
+    "send": ("send_request_headers.started", "send_request_body.complete"),
+    "ttfb": ("receive_response_headers.started", "receive_response_headers.complete"),
+    "body": ("receive_response_body.started", "receive_response_body.complete"),
+}
+
+class RequestTrace:
+    def __init__(self, tracer, method, url):
+        self.tracer = tracer
+        self.method = method
+        self.host = url.host
+        self.path = url.path
+        self.started = time.perf_counter()
+        self.events = {}
+        self.status_code = None
+        self.done = False
+
+    def __call__(self, event_name, info):
+        # Event names look like "connection.connect_tcp.started" or "http11.receive_response_body.complete"
+        name = event_name.split(".", 1)[1]
+        self.events[name] = time.perf_counter()
+        if name == "receive_response_headers.complete":
+            return_value = info.get("return_value")
+            if return_value:
+                self.status_code = return_value[1]
+        elif (name == "response_closed.complete" or name.endswith(".failed")) and not self.done:
+            self.done = True
+            self.tracer.finish(self, failed=name.endswith(".failed"))
+
+    @property
+    def reused_connection(self):
+        return "connect_tcp.started" not in self.events
+
+    def phases(self):
+        phases = {}
+        for phase, (start, end) in PHASES.items():
+            if start in self.events and end in self.events:
+                phases[phase] = self.events[end] - self.events[start]
+        phases["total"] = max(self.events.values(), default=self.started) - self.started
+        return phases
+
+class ConnectionTracer:
+    """Attaches httpcore's "trace" extension to every request made through an httpx client."""
+
+    def __init__(self, on_request=None):
+        self.lock = threading.Lock()
+        self.on_request = on_request
+        self.hosts = {}
+
+    def attach(self, request):
+        # Used as an httpx "request" event hook, the extension is passed through to httpcore
+        request.extensions["trace"] = RequestTrace(self, request.method, request.url)
+
+    def reset(self):
+        # A client outlives a run, the summary covers one
+        with self.lock:
+            self.hosts = {}
+
+    def finish(self, request_trace, failed=False):
+        phases = request_trace.phases()
+        with self.lock:
+            host = self.hosts.setdefault(request_trace.host, {
+                "requests": 0, "reused": 0, "failed": 0,
+                "phases": {phase: LatencyHistogram() for phase in list(PHASES) + ["total"]}
+            })
+            host["requests"] += 1
+            host["reused"] += request_trace.reused_connection
+            host["failed"] += failed
+            for phase, seconds in phases.items():
+                host["phases"][phase].add(seconds)
+        if self.on_request is not None:
+            self.on_request(request_trace, phases, failed)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                host_name: {
+                    "requests": host["requests"],
+                    "reused": host["reused"],
+                    "reuse_rate": host["reused"] / host["requests"] if host["requests"] else 0.0,
+                    "failed": host["failed"],
+                    "phases": {phase: histogram.summary() for phase, histogram in host["phases"].items()}
+                }
+                for host_name, host in self.hosts.items()
+            }
+
+    def summary_lines(self):
+        lines = []
+        for host_name, host in self.to_dict().items():
+            lines.append(f"{host_name}: {host['requests']} requests, "
+                         f"{host['reuse_rate'] * 100:.0f}% on a reused connection")
+            for phase, summary in host["phases"].items():
+                if summary["count"]:
+                    lines.append(f"  {phase:<8} p50 {summary['p50'] * 1000:>6.0f}ms  "
+                                 f"p95 {summary['p95'] * 1000:>6.0f}ms  max {summary['max'] * 1000:>6.0f}ms")
+        return lines
@@ -0,0 +1,174 @@
+import time
+import threading
+
+from . import activity
+from .addon_state import state_path, read_state, write_state, SharedState, load_settings
+
+# Images for notes added in Anki: the note ids go into a queue on disk (new_note_queue.json) that a background
+# worker works through in small batches, so adding a note never waits for an image.
+
+NEW_NOTE_QUEUE_FILE = 'new_note_queue.json'
+
+class NewNoteQueue(SharedState):
+    """Notes added in Anki that still need an image, oldest first. Kept on disk so none are lost on exit."""
+
+    FILENAME = NEW_NOTE_QUEUE_FILE
+
+    def __init__(self, filename=None):
+        super().__init__(filename or state_path(NEW_NOTE_QUEUE_FILE))
+        self.notes = read_state(self.filename, [])
+
+    def __len__(self):
+        return len(self.notes)
+
+    def add(self, nids):
+        with self.lock:
+            self.notes.extend(nid for nid in nids if nid not in self.notes)
+
+    def discard(self, nid):
+        with self.lock:
+            if nid in self.notes:
+                self.notes.remove(nid)
+
+    def nids(self):
+        with self.lock:
+            return list(self.notes)
+
+    def save(self):
+        with self.lock:
+            write_state(self.filename, self.notes)
+
+class NewNoteWorker(threading.Thread):
+    # How often a paused worker checks whether it can go on
+    WAIT_INTERVAL = 1.0
+    # After a batch failed with an error, its notes stay queued and are tried again this much later
+    ERROR_DELAY = 60.0
+
+    def __init__(self, mw):
+        super().__init__(name='dalleforanki-new-notes', daemon=True)
+        self.mw = mw
+        self.core = None
+        self.generator = None
+        self.wake = threading.Event()
+        self.next_slot = 0.0
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+        self.wake.set()
+
+    def run(self):
+        # The generation stack is imported here, never on the main thread that started the worker
+        from . import core
+        self.core = core
+        self.generator = core.BackgroundGenerator(self.mw, notify=activity.show_message)
+        queue = NewNoteQueue.shared()
+        while not self._stopped.is_set():
+            settings = self.generator.settings()
+            batch_size = max(1, int(settings.get("New Note Batch Size", 5)))
+            if not len(queue):
+                activity.monitor.report(None)
+                self.wake.wait()
+                self.wake.clear()
+                continue
+
+            # Notes are usually added one after another, so wait until adding stops or a batch is full
+            self.wake.clear()
+            delay = settings.get("New Note Batch Delay Seconds", 5)
+            if len(queue) < batch_size and self.wake.wait(delay):
+                continue
+            try:
+                self.process_batch(queue, queue.nids()[:batch_size], settings)
+            except Exception as e:
+                core.log_error(f"Error adding images to new notes: {e}", stage="new_notes")
+                self._stopped.wait(self.ERROR_DELAY)
+            queue.save()
+        activity.monitor.report(None)
+        self.generator.close()
+
+    def wait_for_turn(self, settings):
+        # Held back during sync and while the user is active, see activity.py
+        if not activity.monitor.pace(settings, self._stopped.is_set):
+            return False
+        # Images for the cards being reviewed come first, and requests are spread out to the configured rate
+        from . import review
+        while not self._stopped.is_set():
+            review_busy = review.worker is not None and review.worker.is_alive() and review.worker.in_flight
+            if not review_busy and time.monotonic() >= self.next_slot:
+                break
+            time.sleep(self.WAIT_INTERVAL)
+        self.next_slot = time.monotonic() + 60.0 / max(1, settings.get("New Note Images Per Minute", 10))
+        return not self._stopped.is_set()
+
+    def process_batch(self, queue, nids, settings):
+        if self.mw.col is None:
+            self._stopped.set()
+            return
+        # The batch is saved to the collection in one go, after its last note; if that fails, it stays queued
+        engine = self.generator.engine(nids, settings, commit_chunk_size=None,
+                                       before_write=lambda: activity.monitor.wait_for_writes(settings, self._stopped.is_set))
+        collection = engine.collection
+        processed = []
+        for nid in nids:
+            try:
+                note = collection.get_note(nid)
+            except self.core.NoteNotFoundError:
+                processed.append(nid)  # Deleted since it was added
+                continue
+            if not self.generator.needs_image(note, settings):
+                processed.append(nid)
+                continue
+            if not self.wait_for_turn(settings):
+                break
+            engine.process_note(nid, settings)
+            processed.append(nid)
+            if self.generator.breaker.tripped:
+                break
+        engine.save_state()
+        if not activity.monitor.wait_for_writes(settings, self._stopped.is_set):
+            return  # Closed during sync: the notes stay queued and get new images next time
+        collection.flush()
+        # Failed notes are in the failed queue now, like in any other run
+        for nid in processed:
+            queue.discard(nid)
+
+        if self.generator.stop_if_tripped("adding images to new notes"):
+            self._stopped.set()
+
+worker = None
+
+def enabled_for(note, settings):
+    if not settings.get("Generate For New Notes") or not settings.get("API Key"):
+        return False
+    note_types = settings.get("New Note Types") or []
+    return not note_types or note.note_type()["name"] in note_types
+
+def start_worker(mw):
+    global worker
+    if worker is None:
+        worker = NewNoteWorker(mw)
+        worker.start()
+    return worker
+
+def on_note_added(note, mw):
+    if not enabled_for(note, load_settings()):
+        return
+    # Queued on disk first, so the note gets its image even if the worker was stopped by the circuit breaker
+    queue = NewNoteQueue.shared()
+    queue.add([note.id])
+    queue.save()
+    if worker is None or worker.is_alive():
+        start_worker(mw).wake.set()
+
+def on_profile_did_open(mw):
+    # Notes left in the queue when Anki was closed
+    if load_settings().get("Generate For New Notes") and len(NewNoteQueue.shared()):
+        start_worker(mw)
+
+def on_profile_will_close():
+    global worker
+    if worker is not None:
+        worker.stop()
+        if worker.generator is not None:
+            worker.generator.finish(worker)
+        worker = None
@@ -0,0 +1,114 @@
+import os
+import sys
+import cProfile
+import threading
+import tracemalloc
+from datetime import datetime
+
+PROFILE_MODES = ("cprofile", "tracemalloc", "stack_sampling")
+PROFILE_DIR_NAME = 'profiles'
+
+class MainThreadSampler(threading.Thread):
+    """Samples the main thread's stack at a fixed interval and counts identical stacks."""
+
+    def __init__(self, interval):
+        super().__init__(name='dalleforanki-stack-sampler', daemon=True)
+        self.interval = interval
+        self.target_id = threading.main_thread().ident
+        self.counts = {}
+        self.sample_count = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.sample_count += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write_collapsed(self, filename):
+        # One "frame;frame;frame count" line per stack, the input format of most flame graph tools
+        with open(filename, 'w', encoding='utf-8') as output:
+            for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+                output.write(f"{stack} {count}\n")
+
+class RunProfiler:
+    def __init__(self, modes, output_dir, tracemalloc_every=50, sample_interval=0.01):
+        self.modes = [mode for mode in modes if mode in PROFILE_MODES]
+        self.output_dir = output_dir
+        self.tracemalloc_every = max(1, int(tracemalloc_every))
+        self.sample_interval = sample_interval
+        self.prefix = datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.files = []
+        self.profile = None
+        self.sampler = None
+        self._started_tracemalloc = False
+
+    @classmethod
+    def from_settings(cls, settings, addon_dir):
+        return cls(settings.get("Profile Modes", []),
+                   os.path.join(addon_dir, PROFILE_DIR_NAME),
+                   tracemalloc_every=settings.get("Profile Tracemalloc Every N Notes", 50),
+                   sample_interval=settings.get("Profile Sample Interval Ms", 10) / 1000)
+
+    @property
+    def enabled(self):
+        return bool(self.modes)
+
+    def output_path(self, suffix):
+        path = os.path.join(self.output_dir, f"{self.prefix}-{suffix}")
+        self.files.append(path)
+        return path
+
+    def start(self):
+        # Must be called from the worker thread, cProfile only profiles the thread that enables it
+        if not self.enabled:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        if "tracemalloc" in self.modes and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        if "stack_sampling" in self.modes:
+            self.sampler = MainThreadSampler(self.sample_interval)
+            self.sampler.start()
+        if "cprofile" in self.modes:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def note_done(self, note_count):
+        if "tracemalloc" in self.modes and note_count % self.tracemalloc_every == 0:
+            self.write_tracemalloc_snapshot(f"tracemalloc-{note_count:06d}")
+
+    def write_tracemalloc_snapshot(self, name):
+        if not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(self.output_path(f"{name}.snapshot"))
+        current, peak = tracemalloc.get_traced_memory()
+        with open(self.output_path(f"{name}.txt"), 'w', encoding='utf-8') as output:
+            output.write(f"Traced memory: current {current / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB\n\n")
+            for stat in snapshot.statistics('lineno')[:25]:
+                output.write(f"{stat}\n")
+
+    def stop(self):
+        if not self.enabled:
+            return
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.output_path("worker.pstats"))
+        if "tracemalloc" in self.modes:
+            self.write_tracemalloc_snapshot("tracemalloc-final")
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.write_collapsed(self.output_path("main-thread.collapsed"))
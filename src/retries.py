@@ -0,0 +1,105 @@
+import sys
+import time
+import threading
+
+from . import activity
+from .addon_state import load_settings
+
+# Automatic retries ("Auto Retry Failed"): a background worker sleeps until the earliest "Next Retry" in the failed
+# queue and then processes the notes that are due, with the settings they failed with. Like the other background
+# workers it has no window of its own; it is started when the profile opens and woken after each dialog run.
+
+class RetryWorker(threading.Thread):
+    # Failures recorded by the other workers are noticed this long after at most
+    CHECK_INTERVAL = 60.0
+
+    def __init__(self, mw):
+        super().__init__(name='dalleforanki-retries', daemon=True)
+        self.mw = mw
+        self.core = None
+        self.generator = None
+        self.wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+        self.wake.set()
+
+    def run(self):
+        # The generation stack is imported here, never on the main thread that started the worker
+        from . import core
+        self.core = core
+        self.generator = core.BackgroundGenerator(self.mw, notify=activity.show_message)
+        failed_queue = self.core.FailedNoteQueue.shared()
+        while not self._stopped.is_set():
+            settings = self.generator.settings()
+            next_retry = failed_queue.next_retry_time()
+            now = time.time()
+            if not settings.get("Auto Retry Failed") or next_retry is None or next_retry > now or dialog_running():
+                delay = self.CHECK_INTERVAL if next_retry is None or next_retry <= now \
+                    else min(self.CHECK_INTERVAL, next_retry - now)
+                self.wake.wait(delay)
+                self.wake.clear()
+                continue
+            nids = failed_queue.claim(failed_queue.due_nids())
+            try:
+                self.retry(failed_queue, nids, settings)
+            except Exception as e:
+                self.core.log_error(f"Error retrying failed notes: {e}", stage="retry")
+                self._stopped.wait(self.CHECK_INTERVAL)
+            finally:
+                failed_queue.release(nids)
+        self.generator.close()
+
+    def retry(self, failed_queue, nids, settings):
+        if self.mw.col is None:
+            self._stopped.set()
+            return
+        engine = self.generator.engine(nids, settings, note_settings=failed_queue.settings_by_nid(nids),
+                                       before_write=lambda: activity.monitor.wait_for_writes(settings, self._stopped.is_set))
+        for nid in nids:
+            # Held back during sync and while the user is active, see activity.py
+            if not activity.monitor.pace(settings, self._stopped.is_set):
+                break
+            result = engine.process_note(nid, engine.note_settings.get(nid, settings))
+            if result.status == self.core.NoteResult.SKIPPED:
+                failed_queue.cancel_retry(nid)  # Its prompt was rejected before, left for 'Retry Failed'
+            if self.generator.breaker.tripped:
+                break
+        engine.save_state()
+        activity.monitor.report(None)
+
+        if self.generator.stop_if_tripped("retrying failed notes"):
+            self._stopped.set()
+
+worker = None
+
+def dialog_running():
+    # A run started from the dialog may be retrying the same notes
+    gui = sys.modules.get(f'{__package__}.gui')
+    app = gui.app_instance if gui is not None else None
+    return app is not None and app.thread is not None and app.thread.isRunning()
+
+def start_worker(mw):
+    global worker
+    if worker is None:
+        worker = RetryWorker(mw)
+        worker.start()
+    return worker
+
+def on_profile_did_open(mw):
+    if load_settings().get("Auto Retry Failed"):
+        start_worker(mw)
+
+def on_run_finished(mw):
+    # The run may have failed notes to retry, or "Auto Retry Failed" was just turned on
+    if load_settings().get("Auto Retry Failed"):
+        start_worker(mw).wake.set()
+
+def on_profile_will_close():
+    global worker
+    if worker is not None:
+        worker.stop()
+        if worker.generator is not None:
+            worker.generator.finish(worker)
+        worker = None
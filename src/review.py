@@ -0,0 +1,130 @@
+import queue
+import itertools
+import threading
+
+from . import activity
+from .addon_state import load_settings
+
+# Images generated while reviewing: when a card whose image field is empty is shown, its note and the notes
+# of the next cards in the review queue are handed to one background worker, most urgent first.
+# Nothing here touches the collection on the main thread except to read the queue and apply finished notes.
+
+class ReviewImageWorker(threading.Thread):
+    def __init__(self, mw):
+        super().__init__(name='dalleforanki-review', daemon=True)
+        self.mw = mw
+        self.core = None
+        self.generator = None
+        self.requests = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        # In-flight table: notes waiting or being generated, with their current priority (0 = on screen)
+        self.in_flight = {}
+        self.running_nid = None
+        # Notes already handled this session, whatever the outcome; failures go to the failed queue
+        self.finished = set()
+        self._stopped = threading.Event()
+
+    def request(self, nids):
+        """Called on the main thread with the shown card's note first and the upcoming ones after it."""
+        with self.lock:
+            wanted = [nid for nid in dict.fromkeys(nids) if nid not in self.finished]
+            # Waiting notes that are no longer coming up are dropped, their queue entries are skipped
+            for nid in list(self.in_flight):
+                if nid not in wanted and nid != self.running_nid:
+                    del self.in_flight[nid]
+            for priority, nid in enumerate(wanted):
+                if nid == self.running_nid or self.in_flight.get(nid) == priority:
+                    continue
+                self.in_flight[nid] = priority
+                self.requests.put((priority, next(self.sequence), nid))
+
+    def stop(self):
+        self._stopped.set()
+        self.requests.put((-1, next(self.sequence), None))
+
+    def run(self):
+        # The generation stack is imported here, never on the main thread that started the worker. The generator
+        # keeps its breaker across notes, so an account problem stops the worker instead of failing every card shown
+        from . import core
+        self.core = core
+        self.generator = core.BackgroundGenerator(self.mw, notify=activity.show_message)
+        while not self._stopped.is_set():
+            priority, _, nid = self.requests.get()
+            with self.lock:
+                if nid is None or self.in_flight.get(nid) != priority:
+                    continue  # Dropped, or queued again with another priority
+                self.running_nid = nid
+            try:
+                self.generate(nid)
+            except Exception as e:
+                self.core.log_error(f"Error adding an image while reviewing note {nid}: {e}", nid=nid, stage="review")
+            finally:
+                with self.lock:
+                    self.in_flight.pop(nid, None)
+                    self.running_nid = None
+                    self.finished.add(nid)
+        self.generator.close()
+
+    def generate(self, nid):
+        settings = self.generator.settings()
+        if self._stopped.is_set() or self.mw.col is None:
+            return
+        if not self.generator.needs_image(self.mw.col.get_note(nid), settings):
+            return
+
+        # Only held back during sync: these are the cards the user is looking at, so they are never throttled
+        engine = self.generator.engine([nid], settings,
+                                       before_write=lambda: activity.monitor.wait_for_writes(settings, self._stopped.is_set))
+        result = engine.process_note(nid, settings)
+        engine.save_state()
+        if self.generator.stop_if_tripped("adding images while reviewing"):
+            self._stopped.set()
+        elif result.status == self.core.NoteResult.SUCCESS:
+            self.mw.taskman.run_on_main(lambda: self.refresh_card(nid))
+
+    def refresh_card(self, nid):
+        # If the note's card is still on the question side, the answer side is rendered with the new image
+        reviewer = self.mw.reviewer
+        if self.mw.state == 'review' and reviewer.card is not None and reviewer.card.nid == nid \
+                and reviewer.state == 'question':
+            reviewer.card.load()
+
+worker = None
+
+def upcoming_nids(mw, count):
+    # The v3 scheduler can list the next cards without changing anything; older ones only give the current card
+    get_queued_cards = getattr(mw.col.sched, 'get_queued_cards', None)
+    if get_queued_cards is None or count <= 0:
+        return []
+    return [queued.card.note_id for queued in get_queued_cards(fetch_limit=count + 1).cards]
+
+def on_show_question(card, mw):
+    global worker
+    settings = load_settings()
+    if not settings.get("Generate While Reviewing") or not settings.get("API Key"):
+        return
+    try:
+        nids = [card.nid] + upcoming_nids(mw, int(settings.get("Review Prefetch Count", 3)))
+    except Exception as e:
+        print(f'Could not read the review queue: {e}')
+        nids = [card.nid]
+    if worker is None:
+        worker = ReviewImageWorker(mw)
+        worker.start()
+    elif not worker.is_alive():
+        return  # Stopped by the circuit breaker, until the profile is opened again
+    worker.request(nids)
+
+def on_reviewer_will_end():
+    # The note being generated is finished, the upcoming ones are dropped
+    if worker is not None:
+        worker.request([])
+
+def on_profile_will_close():
+    global worker
+    if worker is not None:
+        worker.stop()
+        if worker.generator is not None:
+            worker.generator.finish(worker)
+        worker = None
@@ -0,0 +1,68 @@
+import os
+import json
+import queue
+import atexit
+import logging
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FILE_NAME = 'run_log.jsonl'
+EVENT_FIELDS = ("nid", "stage", "duration", "error_class", "request_id", "retry_count")
+
+logger = logging.getLogger('dalleforanki')
+logger.propagate = False  # Keep our records out of Anki's own log
+
+_file_handler = None
+_queue_handler = None
+_listener = None
+
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname.lower(),
+            "thread": record.threadName,
+        }
+        for field in EVENT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        entry["message"] = record.getMessage()
+        extra = getattr(record, "data", None)
+        if extra:
+            entry.update(extra)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def configure(log_dir, debug=False, max_bytes=5 * 1024 * 1024, backup_count=3):
+    global _file_handler, _queue_handler, _listener
+    if _listener is None:
+        # Worker threads only put records on the queue, a single listener thread does the file I/O
+        _file_handler = RotatingFileHandler(os.path.join(log_dir, LOG_FILE_NAME), maxBytes=max_bytes,
+                                            backupCount=backup_count, encoding='utf-8', delay=True)
+        _file_handler.setFormatter(JsonLineFormatter())
+        log_queue = queue.SimpleQueue()
+        _queue_handler = QueueHandler(log_queue)
+        logger.addHandler(_queue_handler)
+        _listener = QueueListener(log_queue, _file_handler)
+        _listener.start()
+        atexit.register(shutdown)
+    else:
+        _file_handler.maxBytes = max_bytes
+        _file_handler.backupCount = backup_count
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+
+def shutdown():
+    global _listener
+    if _listener is not None:
+        logger.removeHandler(_queue_handler)
+        _listener.stop()
+        _file_handler.close()
+        _listener = None
+
+def log_event(message, level=logging.INFO, data=None, **fields):
+    # Checked up front so disabled debug records cost nothing on the hot path
+    if not logger.isEnabledFor(level):
+        return
+    extra = {field: fields.get(field) for field in EVENT_FIELDS}
+    extra["data"] = data
+    logger.log(level, message, extra=extra)